@@ -5,13 +5,18 @@ from sklearn import preprocessing
 
 
 class DataHolder(object):
-    def __init__(self, data, noise, time):
+    '''
+    connectivity is an optional boolean (num_genes, num_tfs) mask of the candidate regulators
+    of each gene. If given, the interaction weights are only held for its nonzero entries.
+    '''
+    def __init__(self, data, noise, time, connectivity=None):
         self.m_obs, self.f_obs = data
         if noise is not None:
             self.σ2_m_pre, self.σ2_f_pre = noise
         self.t = time[0]
         self.τ = time[1]
         self.common_indices = time[2]
+        self.connectivity = connectivity
 
 def load_humanp53(target_genes):
     with open('data/humanp53/t0to24.tsv', 'r', 1) as f:
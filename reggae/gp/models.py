@@ -1,5 +1,8 @@
 import gpflow
 import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from timeit import default_timer as timer
 
 import tensorflow as tf
@@ -15,26 +18,48 @@ from reggae.gp import LinearResponseKernel, LinearResponseMeanFunction
 class LinearResponseModel():
 
     def __init__(self, data: DataHolder, options: Options, replicate=0):
+        '''
+        If replicate is None, all replicates are fitted jointly: they share the parameters and
+        only differ in their observation variances, so K_xx is block-diagonal across replicates
+        and each (J*T, J*T) block is factorised separately, in one batch.
+        '''
         self.data = data
+        self.options = options
         self.num_genes = data.m_obs.shape[1]
         self.N_m = data.m_obs.shape[2]
-        Y = data.m_obs[replicate]
-        Y_var = data.σ2_m_pre[replicate]
-        self.Y = Y.reshape((-1, 1))
-        self.Y_var = Y_var.reshape(-1)
+        self.joint = replicate is None
+        replicates = range(data.m_obs.shape[0]) if self.joint else [replicate]
+        Y = np.stack([data.m_obs[r].reshape((-1, 1)) for r in replicates])
+        Y_var = np.stack([data.σ2_m_pre[r].reshape(-1) for r in replicates])
+        self.Y = Y if self.joint else Y[0]             # (R, J*T, 1) if joint else (J*T, 1)
+        self.Y_var = Y_var if self.joint else Y_var[0] # (R, J*T) if joint else (J*T,)
         X = np.arange(self.N_m, dtype='float64')*2
         self.X = np.c_[[X for _ in range(self.num_genes)]].reshape(-1, 1)
 
-        self.kernel = LinearResponseKernel(data, self.Y_var)
+        self.kernel = LinearResponseKernel(data, Y_var[0])
         self.mean_function = LinearResponseMeanFunction(data, self.kernel)
         self.internal_model = gpflow.models.GPR(
-            data=(self.X, self.Y), 
+            data=(self.X, Y[0]), 
             kernel=self.kernel, 
             mean_function=self.mean_function
         )
+        self._factors = None # (parameter values, Cholesky factor of K_xx, α), see factors
+
+    def log_marginal_likelihood(self):
+        '''Returns the log marginal likelihood, summed over the replicates if they are fitted jointly'''
+        if not self.joint:
+            return self.internal_model.log_marginal_likelihood()
+        K = self.kernel.K(self.X, None, Y_var=self.Y_var) # (R, J*T, J*T)
+        K += self.internal_model.likelihood.variance * tf.eye(self.X.shape[0], dtype='float64')
+        L = tf.linalg.cholesky(K)
+        α = tf.linalg.triangular_solve(L, self.Y - self.mean_function(self.X))
+        num_obs = tf.cast(tf.size(self.Y), 'float64')
+        return - 0.5 * tf.reduce_sum(tf.square(α)) \
+               - tf.reduce_sum(tm.log(tf.linalg.diag_part(L))) \
+               - 0.5 * num_obs * np.log(2*np.pi)
 
     def objective_closure(self):
-        ret = - self.internal_model.log_marginal_likelihood()
+        ret = - self.log_marginal_likelihood()
         return ret
 
     def fit(self, maxiter=50):
@@ -48,23 +73,88 @@ class LinearResponseModel():
         print(f'Time taken: {(end - start):.04f}s')
         return opt_logs
 
-    def predict_x(self, pred_t, compute_var=True):
-        K_xx = self.kernel.K(self.X, None)
-        K_inv = tf.linalg.inv(K_xx)
-        K_xstarx = tf.transpose(self.kernel.K_xstarx(self.X[:self.N_m], pred_t))
-        K_xstarxK_inv = tf.matmul(K_xstarx, K_inv)
-        KxstarxKinvY = tf.linalg.matvec(K_xstarxK_inv, tf.reshape(self.Y, -1))
-        mu = tf.reshape(KxstarxKinvY, (self.num_genes, pred_t.shape[0]))
+    def factors(self):
+        '''
+        Returns the Cholesky factor L of K_xx and α = K_xx^-1 Y. These are computed once and
+        reused by the predictions until any parameter of the model changes (e.g. by `fit`).
+        '''
+        values = [parameter.numpy() for parameter in self.internal_model.parameters]
+        if self._factors is None or not all(
+                np.array_equal(value, cached) for value, cached in zip(values, self._factors[0])):
+            L = tf.linalg.cholesky(self.kernel.K(self.X, None, Y_var=self.Y_var))
+            α = tf.linalg.cholesky_solve(L, self.Y)
+            self._factors = (values, L, α)
+        return self._factors[1:]
+
+    def predict_marginals(self, pred_t, batch_size=None, compute_var=True):
+        '''
+        Returns the predictive means and marginal variances of the genes at pred_t, each
+        (num_genes, len(pred_t)) or (num_replicates, num_genes, len(pred_t)) if the replicates
+        are fitted jointly, without forming the predictive covariance. The prediction
+        times are processed batch_size at a time (all at once if None) to bound memory.
+        '''
+        L, α = self.factors()
+        batch_shape = L.shape[:-2]
+        batch_size = batch_size or pred_t.shape[0]
+        mu, var = list(), list()
+        for start in range(0, pred_t.shape[0], batch_size):
+            t = pred_t[start:start+batch_size]
+            K_xxstar = self.kernel.K_xstarx(self.X[:self.N_m], t)
+            mu.append(tf.reshape(tf.linalg.matvec(K_xxstar, α[..., 0], transpose_a=True),
+                                 (*batch_shape, self.num_genes, -1)))
+            if compute_var:
+                v = tf.linalg.triangular_solve(L, tf.broadcast_to(K_xxstar, (*batch_shape, *K_xxstar.shape)))
+                var.append(tf.reshape(self.kernel.k_xx_diag(t) - tf.reduce_sum(tf.square(v), axis=-2),
+                                      (*batch_shape, self.num_genes, -1)))
         if compute_var:
-            K_xstarxstar = self.kernel.K_xstarx(pred_t, pred_t)
-            var = K_xstarxstar - tf.matmul(K_xstarxK_inv, tf.transpose(K_xstarx))
-            var = tf.reshape(tf.linalg.diag_part(var), (self.num_genes, pred_t.shape[0]))
-            return mu, var
-        return mu
+            return tf.concat(mu, axis=-1), tf.concat(var, axis=-1)
+        return tf.concat(mu, axis=-1)
+
+    def predict_x(self, pred_t, compute_var=True):
+        return self.predict_marginals(pred_t, compute_var=compute_var)
 
     def predict_f(self, pred_t):
-        Kxx = self.kernel.K(self.X, None)
-        K_inv = tf.linalg.inv(Kxx)
+        L, α = self.factors()
         Kxf = self.kernel.K_xf(self.X, pred_t)
-        KfxKxx = tf.matmul(tf.transpose(Kxf), K_inv)
-        return tf.reshape(tf.matmul(KfxKxx, self.Y), -1)
+        return tf.linalg.matvec(Kxf, α[..., 0], transpose_a=True)
+
+
+def _select_genes(data: DataHolder, genes):
+    '''Returns a DataHolder of the genes (indices into data.m_obs) and all the TFs'''
+    connectivity = None if data.connectivity is None else data.connectivity[genes]
+    return DataHolder((data.m_obs[:, genes], data.f_obs),
+                      (data.σ2_m_pre[:, genes], data.σ2_f_pre),
+                      (data.t, data.τ, data.common_indices),
+                      connectivity=connectivity)
+
+_worker_data = None # (data, options) of a fit_gene_groups worker, see _init_worker
+
+def _init_worker(data, options):
+    global _worker_data
+    _worker_data = (data, options)
+
+def _fit_gene_group(genes, replicate, maxiter):
+    data, options = _worker_data
+    model = LinearResponseModel(_select_genes(data, genes), options, replicate=replicate)
+    model.fit(maxiter=maxiter)
+    return {path: parameter.numpy()
+            for path, parameter in gpflow.utilities.parameter_dict(model.internal_model).items()}
+
+def fit_gene_groups(data: DataHolder, options: Options, gene_groups, replicate=0, maxiter=50, num_workers=None):
+    '''
+    Fits an independent LinearResponseModel to each group of genes (a list of gene indices)
+    in a pool of num_workers processes (one per CPU if None), and returns the fitted models.
+    The data is sent to each worker once, when it starts, rather than with every group;
+    the workers only send back the fitted parameter values.
+    '''
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(data, options)) as executor:
+        fitted = list(executor.map(_fit_gene_group, gene_groups, repeat(replicate), repeat(maxiter)))
+    models = list()
+    for genes, parameters in zip(gene_groups, fitted):
+        model = LinearResponseModel(_select_genes(data, genes), options, replicate=replicate)
+        gpflow.utilities.multiple_assign(model.internal_model, parameters)
+        models.append(model)
+    return models
@@ -56,77 +56,36 @@ class LinearResponseKernel(gpflow.kernels.Kernel):
         self.block_size = X.shape[0]
         self.hori_block_size = int(X2.shape[0])
         self.vert_block_size = int(X.shape[0])
-        shape = [X.shape[0]*self.num_genes, X2.shape[0]*self.num_genes]
-        K_xx = tf.zeros(shape, dtype='float64')
-        for j in range(self.num_genes):
-            for k in range(self.num_genes):
-                mask = np.ones(shape)
-                other = np.zeros(shape)
-                mask[j*self.vert_block_size:(j+1)*self.vert_block_size, 
-                     k*self.hori_block_size:(k+1)*self.hori_block_size] = 0
-                pad_top = j*self.vert_block_size
-                pad_left = k*self.hori_block_size
-                pad_right = 0 if k == self.num_genes-1 else shape[1]-self.hori_block_size-pad_left
-                pad_bottom = 0 if j == self.num_genes-1 else shape[0]-self.vert_block_size-pad_top
-                kxx = self.k_xx(X, j, k, t_y=X2)
-                other = tf.pad(kxx, tf.constant([
-                    [pad_top,pad_bottom],
-                    [pad_left,pad_right]
-                ]), 'CONSTANT')
-                K_xx = K_xx * mask + other * (1 - mask)
+        return self._k_xx(tf.reshape(X, (-1,)), tf.reshape(X2, (-1,)))
 
-        return K_xx
-
-    def K(self, X, X2=None):
-        '''Computes Kxx'''
+    def K(self, X, X2=None, Y_var=None):
+        '''
+        Computes Kxx. Y_var (..., J*T) overrides the observation variances given at construction,
+        e.g. with those of several replicates, in which case Kxx has their leading batch shape.
+        '''
         self.block_size = int(X.shape[0]/self.num_genes)
         if X2 is None:
-            shape = [X.shape[0],X.shape[0]]
-            K_xx = tf.zeros(shape, dtype='float64')
-            for j in range(self.num_genes):
-                for k in range(self.num_genes):
-                    mask = np.ones(shape)
-                    other = np.zeros(shape)
-                    mask[j*self.block_size:(j+1)*self.block_size, 
-                         k*self.block_size:(k+1)*self.block_size] = 0
-
-                    pad_top = j*self.block_size
-                    pad_left = k*self.block_size
-                    pad_right = 0 if k == self.num_genes-1 else shape[0]-self.block_size-pad_left
-                    pad_bottom = 0 if j == self.num_genes-1 else shape[0]-self.block_size-pad_top
-                    kxx = self.k_xx(X, j, k)
-                    other = tf.pad(kxx,
-                                      tf.constant([
-                                          [pad_top,pad_bottom],
-                                          [pad_left,pad_right]
-                                   ]), 'CONSTANT'
-                                  )
-                    K_xx = K_xx * mask + other * (1 - mask)
-
-    #         K_xx = self.k_xx(X, 0,0)        
+            Y_var = self.Y_var if Y_var is None else Y_var
+            K_xx = self._k_xx(tf.reshape(X[:self.block_size], (-1,)))
             white = tf.linalg.diag(broadcast_tile(tf.reshape(self.noise_term, (1, -1)), 1, self.block_size)[0])
-            return K_xx + tf.linalg.diag((1e-5*tf.ones(X.shape[0], dtype='float64'))+self.Y_var) + white
+            return K_xx + tf.linalg.diag((1e-5*tf.ones(X.shape[0], dtype='float64'))+Y_var) + white
         else:
             print('X not none', X2)
             return self.K_xf(X, X2)
 
     def K_xf(self, X, X2):
-        '''Calculate K_xf: no need to use tf.* since this part is not optimised'''
-        shape = [X.shape[0],X2.shape[0]]#self.block_size]
-
-        K_xf = tf.zeros(shape, dtype='float64')
-        for j in range(self.num_genes):
-            mask = np.ones(shape)
-            other = np.zeros(shape)
-            mask[j*self.block_size:(j+1)*self.block_size] = 0
-            pad_top = j*self.block_size
-            pad_bottom = 0 if j == self.num_genes-1 else shape[0]-self.block_size-pad_top
-            kxf = self.k_xf(j, X, X2)
-            other = tf.pad(kxf, tf.constant([[pad_top,pad_bottom],[0,0]]), 'CONSTANT')
+        '''Calculate K_xf, stacking the blocks of all genes, shape (J*block_size, len(X2))'''
+        self.block_size = int(X.shape[0]/self.num_genes)
+        t_prime, t_, t_dist = self.get_distance_matrix(t_x=tf.reshape(X[:self.block_size], (-1,)), 
+                                                       t_y=tf.reshape(X2, (-1, )))
+        l = self.lengthscale
+        D = tf.reshape(self.D, (-1, 1, 1))
+        S = tf.reshape(self.S, (-1, 1, 1))
+        γ = D*l/2
+        erf_term = tfm.erf(t_dist/l - γ) + tfm.erf(t_/l + γ)
+        K_xf = S*l*0.5*tfm.sqrt(PI)*tfm.exp(γ**2) *tfm.exp(-D*t_dist)*erf_term # (J, block_size, len(X2))
+        return tf.reshape(K_xf, (-1, K_xf.shape[-1]))
 
-            K_xf = K_xf * mask + other * (1 - mask)
-        return K_xf
-        
     def k_xf(self, j, X, X2):
         t_prime, t_, t_dist = self.get_distance_matrix(t_x=tf.reshape(X[:self.block_size], (-1,)), 
                                                        t_y=tf.reshape(X2, (-1, )))
@@ -156,44 +115,53 @@ class LinearResponseKernel(gpflow.kernels.Kernel):
         mult = self.S[j]*self.S[k]*self.lengthscale*0.5*tfm.sqrt(PI)
         return self.kervar**2*mult*(self.h(X, k, j, t_y=t_y) + self.h(X, j, k, t_y=t_y, primefirst=False))
     
-    def h_(self, X, k, j, primefirst=True):
-        Dj = tf.reshape(self.D, (1, -1))
-        Dj = broadcast_tile(Dj, 1, 7)
-        Dj = tf.tile(Dj, [35, 1])
-        Dk = tf.reshape(self.D, (-1, 1)) 
-        Dk = broadcast_tile(Dk, 7, 1)
-        Dk = tf.tile(Dk, [1, 35])
-        gk = tf.transpose(broadcast_tile(tf.reshape(self.gamma(), (-1, 1)), 7, 1))
-        gk = tf.tile(gk, [35, 1])
-        if not primefirst:
-            Dk, Dj = Dj, Dk
-            gk = tf.transpose(broadcast_tile(tf.reshape(self.gamma(), (1,-1)), 1, 7))
-            gk = tf.tile(gk, [1, 35])
-
+    def h_(self, t_prime, t, t_dist, D_k, D_j):
+        '''
+        Computes h as in `h` for every gene pair at once: D_k and D_j are the degradation rates
+        with gene axes that broadcast against each other and in front of the times (N, M).
+        '''
         l = self.lengthscale
-        t_x = tf.reshape(X[:self.block_size], (-1,))
-        t_prime, t, t_dist = self.get_distance_matrix(primefirst=primefirst, t_x=t_x)
-        t_prime = tf.tile(t_prime, [5, 5])
-        t = tf.tile(t, [5, 5])
-        t_dist = tf.tile(t_dist, [5, 5])
-        multiplier = tfm.exp(gk**2) / (Dj + Dk)
-        first_erf_term = tfm.erf(t_dist/l - gk) + tfm.erf(t/l + gk)
-        second_erf_term = tfm.erf(t_prime/l - gk) + tfm.erf(gk)
-        return multiplier * (tf.multiply(tfm.exp(-Dk*t_dist) , first_erf_term) - \
-                             tf.multiply(tfm.exp(-Dk*t_prime-Dj*t) , second_erf_term))
-
-
-    def _k_xx(self, X, j, k):
-        S_square = tf.matmul(tf.reshape(self.S, (-1, 1)), tf.reshape(self.S, (1, -1)))
-        S_square = broadcast_tile(S_square, 7, 7)
+        γ_k = D_k*l/2
+        multiplier = tfm.exp(γ_k**2) / (D_j+D_k)
+        first_erf_term = tfm.erf(t_dist/l - γ_k) + tfm.erf(t/l + γ_k)
+        second_erf_term = tfm.erf(t_prime/l - γ_k) + tfm.erf(γ_k)
+        return multiplier * (tf.multiply(tfm.exp(-D_k*t_dist) , first_erf_term) - \
+                             tf.multiply(tfm.exp(-D_k*t_prime-D_j*t) , second_erf_term))
+
+    def _k_xx(self, t_x, t_y=None):
+        '''
+        Computes the cross-covariance of all genes at times t_x (N,) and t_y (M,), shape (J*N, J*M),
+        in one broadcast over gene pairs: block (j, k) is k_xx(t_x, j, k, t_y).
+        '''
+        t_prime, t, t_dist = self.get_distance_matrix(t_x=t_x, t_y=t_y)
+        D_j = tf.reshape(self.D, (-1, 1, 1, 1))
+        D_k = tf.reshape(self.D, (1, -1, 1, 1))
+        S_square = tf.reshape(self.S, (-1, 1, 1, 1)) * tf.reshape(self.S, (1, -1, 1, 1))
         mult = S_square*self.lengthscale*0.5*tfm.sqrt(PI)
-        return self.kervar**2*mult*(self.h(X, k, j) + self.h(X, j, k, primefirst=False))
+        K_xx = self.kervar**2*mult*(self.h_(t_prime, t, t_dist, D_k, D_j) +
+                                    self.h_(t, t_prime, -t_dist, D_j, D_k)) # (J, J, N, M)
+        N, M = K_xx.shape[-2:]
+        return tf.reshape(tf.transpose(K_xx, [0, 2, 1, 3]), (self.num_genes*N, self.num_genes*M))
+
+    def k_xx_diag(self, t):
+        '''Computes the diagonal of _k_xx(t, t), shape (J*N,), without forming the matrix'''
+        t = tf.reshape(t, (1, -1))
+        D = tf.reshape(self.D, (-1, 1))
+        mult = tf.reshape(tf.square(self.S), (-1, 1))*self.lengthscale*0.5*tfm.sqrt(PI)
+        # Both terms of k_xx coincide at t = t'
+        K_diag = self.kervar**2*mult*2*self.h_(t, t, tf.zeros_like(t), D, D)
+        return tf.reshape(K_diag, (-1,))
 
     def get_distance_matrix(self, t_x, primefirst=True, t_y=None):
+        '''
+        Returns the times t_x as a column (N, 1), t_y as a row (1, M) and their differences (N, M),
+        or (t_y, t_x, t_y - t_x) if not primefirst. The times broadcast to the (N, M) grid
+        in the covariance expressions, so only the differences are materialised.
+        '''
         if t_y is None:
             t_y = t_x
-        t_1 = tf.transpose(tf.reshape(tf.tile(t_x, [t_y.shape[0]]), [ t_y.shape[0], t_x.shape[0]]))
-        t_2 = tf.reshape(tf.tile(t_y, [t_x.shape[0]]), [ t_x.shape[0], t_y.shape[0]])
+        t_1 = tf.reshape(t_x, (-1, 1))
+        t_2 = tf.reshape(t_y, (1, -1))
         if primefirst:
             return t_1, t_2, t_1-t_2
         return t_2, t_1, t_2-t_1
@@ -0,0 +1,128 @@
+import tensorflow as tf
+from tensorflow import math as tfm
+
+import numpy as np
+
+'''
+State-space algebra for the Matérn latent kernels. A Matérn-(p+1/2) GP is the first component
+of a (p+1)-dimensional linear SDE (Hartikainen & Särkkä, 2010), so on a grid τ of N points
+prior draws, log densities and conditioning on noisy observations are Kalman recursions in
+O(N) rather than the O(N^3) of a dense Cholesky. f and y have time as their last axis.
+'''
+
+
+def matern_sde(order, v, l):
+    '''
+    Returns the feedback matrix F and the stationary state covariance P, each (..., d, d) with
+    d = order+1, of the SDE of the Matérn-(order+1/2) kernel with variance v and lengthscale l (...).
+    '''
+    λ = np.sqrt(2*order+1) / l
+    zero, one = tf.zeros_like(λ), tf.ones_like(λ)
+    if order == 0:
+        return -λ[..., None, None], v[..., None, None]
+    if order == 1:
+        F = tf.stack([tf.stack([zero, one], -1),
+                      tf.stack([-λ**2, -2*λ], -1)], -2)
+        P = tf.stack([tf.stack([v, zero], -1),
+                      tf.stack([zero, v*λ**2], -1)], -2)
+        return F, P
+    κ = v*λ**2/3
+    F = tf.stack([tf.stack([zero, one, zero], -1),
+                  tf.stack([zero, zero, one], -1),
+                  tf.stack([-λ**3, -3*λ**2, -3*λ], -1)], -2)
+    P = tf.stack([tf.stack([v, zero, -κ], -1),
+                  tf.stack([zero, κ, zero], -1),
+                  tf.stack([-κ, zero, v*λ**4], -1)], -2)
+    return F, P
+
+
+def transitions(F, P, τ):
+    '''Returns the transition matrices A and process noise covariances Q, (..., N-1, d, d), along τ'''
+    Δ = tf.constant(np.diff(τ), dtype=F.dtype)[:, None, None]
+    A = tf.linalg.expm(F[..., None, :, :] * Δ)
+    P = P[..., None, :, :]
+    return A, P - A @ P @ tf.linalg.matrix_transpose(A)
+
+
+def time_first(x, event_rank=0):
+    '''Moves the time axis, which is followed by event_rank axes, to the front'''
+    return tf.experimental.numpy.moveaxis(x, -1-event_rank, 0)
+
+
+def state_space_sample(F, P, τ, sample_shape=()):
+    '''Draws samples (*sample_shape, ..., N) of the GP on τ by simulating its SDE'''
+    A, Q = transitions(F, P, τ)
+    N, d = len(τ), P.shape[-1]
+    shape = (*sample_shape, *P.shape[:-2])
+    jitter = 1e-12*tf.eye(d, dtype=P.dtype) # the process noise of smooth kernels is tiny over short steps
+    x_0 = tf.linalg.matvec(tf.linalg.cholesky(P), tf.random.normal((*shape, d), dtype=P.dtype))
+    noise = tf.linalg.matvec(tf.linalg.cholesky(Q + jitter), tf.random.normal((*shape, N-1, d), dtype=P.dtype))
+
+    def step(x, elems):
+        A_k, noise_k = elems
+        return tf.linalg.matvec(A_k, x) + noise_k
+    x = tf.scan(step, (time_first(A, 2), time_first(noise, 1)), initializer=x_0)
+    f = tf.concat([x_0[None], x], axis=0)[..., 0]
+    return tf.experimental.numpy.moveaxis(f, 0, -1)
+
+
+def kalman_filter(A, Q, P, y, noise):
+    '''
+    Filters observations y (..., N) of the first state component with variances noise, a scalar
+    or (N,), starting from the stationary covariance P. Returns the filtered means (N, ..., d)
+    and covariances (N, ..., d, d), the predicted ones likewise, and the log marginal
+    likelihood of y (...).
+    '''
+    N, d = y.shape[-1], P.shape[-1]
+    noise = tf.broadcast_to(tf.cast(noise, y.dtype), (N,))
+    # Each step updates with y_k and then predicts k+1, so the last transition is unused
+    A = tf.concat([A, A[..., -1:, :, :]], axis=-3)
+    Q = tf.concat([Q, Q[..., -1:, :, :]], axis=-3)
+
+    def step(carry, elems):
+        m, C, _, _, log_lik = carry
+        y_k, r_k, A_k, Q_k = elems
+        S = C[..., 0, 0] + r_k
+        gain = C[..., :, 0] / S[..., None]
+        residual = y_k - m[..., 0]
+        m_filtered = m + gain * residual[..., None]
+        C_filtered = C - gain[..., :, None] * gain[..., None, :] * S[..., None, None]
+        log_lik = log_lik - 0.5*(tfm.log(2*np.pi*S) + tfm.square(residual)/S)
+        m = tf.linalg.matvec(A_k, m_filtered)
+        C = A_k @ C_filtered @ tf.linalg.matrix_transpose(A_k) + Q_k
+        return m, C, m_filtered, C_filtered, log_lik
+
+    batch_shape = tf.broadcast_static_shape(y.shape[:-1], P.shape[:-2])
+    m_0 = tf.zeros((*batch_shape, d), dtype=y.dtype)
+    m_pred, C_pred, m_filt, C_filt, log_lik = tf.scan(
+        step, (time_first(y), noise, time_first(A, 2), time_first(Q, 2)),
+        initializer=(m_0, P, m_0, P, tf.zeros(batch_shape, dtype=y.dtype)))
+    # The scan emits the predictions for k+1, so shift them to line up with k
+    m_pred = tf.concat([m_0[None], m_pred[:-1]], axis=0)
+    C_pred = tf.concat([P[None], C_pred[:-1]], axis=0)
+    return m_filt, C_filt, m_pred, C_pred, log_lik[-1]
+
+
+def rts_smoother_mean(A, m_filt, C_filt, m_pred, C_pred):
+    '''Returns the smoothed state means (N, ..., d) from the output of kalman_filter'''
+    def step(m_next, elems):
+        A_k, m_k, C_k, m_pred_next, C_pred_next = elems
+        gain_T = tf.linalg.solve(C_pred_next, A_k @ C_k) # the smoother gain is C_k A_k^T C_pred_next^-1
+        return m_k + tf.linalg.matvec(gain_T, m_next - m_pred_next, transpose_a=True)
+    m = tf.scan(step, (time_first(A, 2), m_filt[:-1], C_filt[:-1], m_pred[1:], C_pred[1:]),
+                initializer=m_filt[-1], reverse=True)
+    return tf.concat([m, m_filt[-1:]], axis=0)
+
+
+def state_space_log_prob(F, P, τ, f, jitter=1e-8):
+    '''Log density of f (..., N) under the GP on τ, with jitter added to the diagonal of its covariance'''
+    A, Q = transitions(F, P, τ)
+    return kalman_filter(A, Q, P, f, jitter)[-1]
+
+
+def state_space_posterior_mean(F, P, τ, y, noise):
+    '''Returns K(K + diag(noise))^-1 y (..., N), the GP posterior mean given y observed with variances noise'''
+    A, Q = transitions(F, P, τ)
+    m_filt, C_filt, m_pred, C_pred, _ = kalman_filter(A, Q, P, y, noise)
+    m = rts_smoother_mean(A, m_filt, C_filt, m_pred, C_pred)[..., 0]
+    return tf.experimental.numpy.moveaxis(m, 0, -1)
@@ -1,4 +1,5 @@
-from reggae.utilities import get_time_square, FixedDistribution
+from reggae.utilities import FixedDistribution, inducing_points, jitter_cholesky, LRUCache
+from reggae.gp.state_space import matern_sde
 
 import tensorflow as tf
 from tensorflow import math as tfm
@@ -7,19 +8,33 @@ import numpy as np
 
 f64 = np.float64
 
+MATERN_ORDERS = {'matern12': 0, 'matern32': 1, 'matern52': 2} # ν = order + 1/2
+
 class GPKernelSelector():
-    def __init__(self, data, options):
+    def __init__(self, data, options, cache_size=2):
         self.kernel = options.kernel
         self.options = options
-        self.τ = data.τ        
-        self.N_p = data.τ.shape[0]
+        # The latent GP is over τ, or over the inducing points if the latents are low-rank
+        self.τ = data.τ
+        if options.num_inducing is not None:
+            self.τ = inducing_points(data.τ, options.num_inducing)
+        self.N_p = self.τ.shape[0]
+        # Stationary kernels on a uniform grid have Toeplitz covariances
+        spacing = np.diff(self.τ)
+        self.toeplitz = options.toeplitz and self.kernel == 'rbf' and np.allclose(spacing, spacing[0])
+        # Matérn kernels are the marginals of linear SDEs, so their latent prior is handled by Kalman recursions
+        self.state_space = self.kernel in MATERN_ORDERS
         self.num_tfs = data.f_obs.shape[1]
-        t_1, t_2 = get_time_square(self.τ, self.N_p)
-        self.t_dist = t_1-t_2
-        self.tt = t_1*t_2
-        self.t2 = tf.square(t_1)
-        self.tprime2 = tf.square(t_2)
+        # Covariances are built by broadcasting the times as a column against a row, so
+        # that no N_p x N_p time matrices outlive the covariance being computed
+        self.t_col = tf.constant(self.τ[:, None], dtype='float64')
+        self.t_row = tf.constant(self.τ[None, :], dtype='float64')
         self.fixed_dist = FixedDistribution(tf.ones(self.num_tfs, dtype='float64'))
+        # Covariances (cache) or their Cholesky factors (cholesky_cache) keyed on the
+        # hyperparameters, allocated by enable_cache; cache.hits and cache.misses count the lookups
+        self.cache = None
+        self.cholesky_cache = None
+        self.cache_size = cache_size
         min_dist = min(data.t[1:]-data.t[:-1])
         min_dist = max(min_dist, 1.)
         self._ranges = {
@@ -38,6 +53,10 @@ class GPKernelSelector():
             'rbf': proposals,
         }
         self._names = {'rbf': ['v','l2'], 'mlp': ['w', 'b']}
+        # Matérn kernels share the variance and squared lengthscale parameters of the rbf
+        for kernel in MATERN_ORDERS:
+            for attribute in [self._ranges, self._priors, self._proposals, self._names]:
+                attribute[kernel] = attribute['rbf']
 
     def __call__(self):
         '''Calculates kernel covariance matrix'''
@@ -45,11 +64,13 @@ class GPKernelSelector():
             return self.rbf
         elif self.kernel == 'mlp':
             return self.mlp
+        elif self.kernel in MATERN_ORDERS:
+            return self.matern
         else:
             raise Exception('No kernel by that name!')
 
     def initial_params(self):
-        if self.kernel == 'rbf':
+        if self.kernel == 'rbf' or self.kernel in MATERN_ORDERS:
             return [1.1*tf.ones(self.num_tfs, dtype='float64'), 
                     2*tf.ones(self.num_tfs, dtype='float64')]
         elif self.kernel == 'mlp':
@@ -69,20 +90,86 @@ class GPKernelSelector():
             return self.fixed_dist
         return self._proposals[self.kernel][hyp_index](current_val)
 
+    def enable_cache(self, cholesky=False):
+        '''
+        Allocates the cache of the covariances or, if cholesky, of their Cholesky factors, which
+        holds cache_size sets of hyperparameters (by default the current and proposed ones).
+        Only samplers which use the dense prior call this, and they must do so on construction:
+        the caches are held in tf.Variables, which cannot be created when a tf.function is retraced.
+        '''
+        shape = (self.num_tfs, self.N_p, self.N_p)
+        if cholesky and self.cholesky_cache is None:
+            self.cholesky_cache = LRUCache((2*self.num_tfs,), [shape], size=self.cache_size)
+        elif not cholesky and self.cache is None:
+            self.cache = LRUCache((2*self.num_tfs,), [shape], size=self.cache_size)
+
+    def covariance(self, param_0, param_1):
+        '''
+        Returns the latent prior covariances (I, N_p, N_p), from the cache if it is enabled.
+        Cached values carry no gradient, so hyperparameters which are being differentiated
+        (e.g. in a NUTS block) should use __call__ instead.
+        '''
+        compute = lambda: [self()(param_0, param_1)[1]]
+        if self.cache is None:
+            return compute()[0]
+        return self.cache(tf.concat([param_0, param_1], axis=0), compute)[0]
+
+    def cholesky(self, param_0, param_1, cached=False):
+        '''
+        Returns the Cholesky factors (I, N_p, N_p) of the latent prior covariances. If cached,
+        they are taken from the Cholesky cache if it is enabled, see covariance.
+        '''
+        compute = lambda: [jitter_cholesky(self()(param_0, param_1)[1])]
+        if not cached or self.cholesky_cache is None:
+            return compute()[0]
+        return self.cholesky_cache(tf.concat([param_0, param_1], axis=0), compute)[0]
+
     def rbf(self, v, l2):
         if self.options.kernel_exponential:
             v = tf.exp(v)
             l2 = tf.exp(l2)
-        sq_dist = tf.divide(tfm.square(self.t_dist), tf.reshape(2*l2, (-1, 1, 1)))
+        sq_dist = tf.divide(tfm.square(self.t_col - self.t_row), tf.reshape(2*l2, (-1, 1, 1)))
         K = tf.reshape(v, (-1, 1, 1)) * tfm.exp(-sq_dist)
         m = tf.zeros((self.N_p), dtype='float64')
         return m, K
 
+    def rbf_row(self, v, l2, num=None):
+        '''
+        Returns the first row (I, N_p) of the Toeplitz RBF covariance on a uniform grid, or its
+        continuation to the first num lags of the grid spacing, e.g. for a circulant embedding
+        '''
+        if self.options.kernel_exponential:
+            v = tf.exp(v)
+            l2 = tf.exp(l2)
+        lags = self.τ - self.τ[0]
+        if num is not None:
+            lags = (self.τ[1] - self.τ[0]) * tf.cast(tf.range(num), 'float64')
+        sq_dist = tfm.square(lags) / tf.reshape(2*l2, (-1, 1))
+        return tf.reshape(v, (-1, 1)) * tfm.exp(-sq_dist)
+
+    def matern(self, v, l2):
+        if self.options.kernel_exponential:
+            v = tf.exp(v)
+            l2 = tf.exp(l2)
+        order = MATERN_ORDERS[self.kernel]
+        x = np.sqrt(2*order+1) * tfm.abs(self.t_col - self.t_row) / tf.reshape(tfm.sqrt(l2), (-1, 1, 1))
+        polynomial = [tf.ones_like(x), 1 + x, 1 + x + tfm.square(x)/3][order]
+        K = tf.reshape(v, (-1, 1, 1)) * polynomial * tfm.exp(-x)
+        m = tf.zeros((self.N_p), dtype='float64')
+        return m, K
+
+    def sde(self, v, l2):
+        '''Returns the state-space form (F, P) of the Matérn latent prior, see reggae.gp.state_space'''
+        if self.options.kernel_exponential:
+            v = tf.exp(v)
+            l2 = tf.exp(l2)
+        return matern_sde(MATERN_ORDERS[self.kernel], v, tfm.sqrt(l2))
+
     def mlp(self, w, b):
         w = tf.reshape(w, (-1, 1, 1))
         b = tf.reshape(b, (-1, 1, 1))
-        denom = tfm.sqrt((w*self.t2 + b + 1) * (w*self.tprime2 + b + 1))
-        K = tfm.asin((w*self.tt + b)/denom)
+        denom = tfm.sqrt((w*tfm.square(self.t_col) + b + 1) * (w*tfm.square(self.t_row) + b + 1))
+        K = tfm.asin((w*self.t_col*self.t_row + b)/denom)
         m = tf.zeros((self.N_p), dtype='float64')
         return m, K
 
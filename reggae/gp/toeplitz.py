@@ -0,0 +1,121 @@
+import tensorflow as tf
+from tensorflow import math as tfm
+
+import numpy as np
+
+from reggae.utilities import jitter_cholesky
+
+'''
+Structured algebra for symmetric Toeplitz covariances, i.e. stationary kernels on a uniform
+grid. A matrix is represented by its first row c (..., N), so that K[m, n] = c[|m - n|].
+'''
+
+
+def circulant_embedding(c):
+    '''Returns the first row (..., 2N-2) of the smallest circulant matrix containing toeplitz(c)'''
+    return tf.concat([c, tf.reverse(c[..., 1:-1], axis=[-1])], axis=-1)
+
+
+def toeplitz_matvec(c, x):
+    '''Computes toeplitz(c) @ x for x (..., N) in O(N log N) using the circulant embedding'''
+    N = c.shape[-1]
+    embedding = tf.signal.rfft(circulant_embedding(c))
+    x = tf.pad(x, [[0, 0]]*(x.shape.rank-1) + [[0, N-2]])
+    return tf.signal.irfft(embedding * tf.signal.rfft(x), fft_length=[2*N-2])[..., :N]
+
+
+def toeplitz_sample(row_fn, N, sample_shape=(), max_doublings=6, tolerance=1e-10):
+    '''
+    Draws samples of N(0, toeplitz(c)), shape (*sample_shape, ..., N), in O(N log N) by
+    circulant embedding, where row_fn(num) returns the covariances c (..., num) at the first
+    num lags of the grid. The draw is exact when the embedding is positive semi-definite,
+    so the smallest embedding (of size 2N-2) is doubled, with the kernel evaluated at the
+    extra lags, until its eigenvalues are non-negative up to round-off (tolerance times the
+    largest). If this fails after max_doublings, the samples are drawn densely instead.
+    '''
+    def embedding_eigenvalues(M):
+        c = row_fn(M//2 + 1)
+        return tf.math.real(tf.signal.fft(tf.cast(circulant_embedding(c), 'complex128')))
+
+    def is_psd(eigenvalues):
+        return tf.reduce_all(tf.reduce_min(eigenvalues, axis=-1) >= -tolerance*tf.reduce_max(eigenvalues, axis=-1))
+
+    M = tf.constant(2*N - 2)
+    max_size = (2*N - 2) * 2**max_doublings
+    eigenvalues = embedding_eigenvalues(M)
+    M, eigenvalues = tf.while_loop(
+        lambda M, eigenvalues: tfm.logical_and(tfm.logical_not(is_psd(eigenvalues)), M < max_size),
+        lambda M, eigenvalues: (2*M, embedding_eigenvalues(2*M)),
+        (M, eigenvalues),
+        shape_invariants=(M.shape, tf.TensorShape([*eigenvalues.shape[:-1], None])))
+
+    def circulant_sample():
+        shape = tf.concat([sample_shape, tf.shape(eigenvalues)], axis=0)
+        ε = tf.complex(tf.random.normal(shape, dtype='float64'), tf.random.normal(shape, dtype='float64'))
+        # Eigenvalues within round-off of zero may be slightly negative
+        scale = tfm.sqrt(tfm.maximum(eigenvalues, 0) / tf.cast(M, 'float64'))
+        sample = tf.signal.fft(tf.cast(scale, 'complex128') * ε)
+        return tf.math.real(sample)[..., :N]
+
+    def dense_sample():
+        tf.print('Warning: circulant embedding is not positive semi-definite, sampling the Toeplitz prior densely')
+        lags = tfm.abs(tf.range(N)[:, None] - tf.range(N)[None, :])
+        L = jitter_cholesky(tf.gather(row_fn(N), lags, axis=-1))
+        ε = tf.random.normal((*sample_shape, *L.shape[:-1]), dtype='float64')
+        return tf.linalg.matvec(L, ε)
+
+    return tf.ensure_shape(tf.cond(is_psd(eigenvalues), circulant_sample, dense_sample),
+                           (*sample_shape, *eigenvalues.shape[:-1], N))
+
+
+def levinson(c, y):
+    '''
+    Solves toeplitz(c) x = y for symmetric positive-definite toeplitz(c) by the Levinson
+    recursion (Golub & Van Loan, Alg. 4.7.3), in O(N^2) rather than the O(N^3) of a Cholesky.
+    Returns x and log det toeplitz(c). c and y are (..., N) with broadcastable batch dimensions.
+    '''
+    N = c.shape[-1]
+    c0 = c[..., :1]
+    r = c[..., 1:] / c0 # normalised so that the diagonal is one
+    b = y / c0
+    shape = tf.broadcast_dynamic_shape(tf.shape(r[..., :1]), tf.shape(b[..., :1]))
+    r = tf.broadcast_to(tf.concat([r, tf.zeros_like(r[..., :1])], axis=-1), tf.concat([shape[:-1], [N]], 0))
+    b = tf.broadcast_to(b, tf.shape(r))
+    positions = tf.range(N)
+
+    def reversed_prefix(v, k):
+        # v[k-1], ..., v[0] followed by zeros
+        return tf.where(positions < k, tf.gather(v, tfm.maximum(k-1-positions, 0), axis=-1), tf.zeros([], v.dtype))
+
+    def prefix(v, k):
+        return tf.where(positions < k, v, tf.zeros([], v.dtype))
+
+    def extend(v, k, value):
+        return tf.where(positions == k, value[..., None], v)
+
+    def step(k, x, z, α, β, log_det):
+        β = (1 - tfm.square(α)) * β
+        μ = (b[..., k] - tf.reduce_sum(prefix(r, k) * reversed_prefix(x, k), axis=-1)) / β
+        x = extend(prefix(x, k) + μ[..., None] * reversed_prefix(z, k), k, μ)
+        α_next = -(r[..., k] + tf.reduce_sum(prefix(r, k) * reversed_prefix(z, k), axis=-1)) / β
+        z = extend(prefix(z, k) + α_next[..., None] * reversed_prefix(z, k), k, α_next)
+        return k+1, x, z, α_next, β, log_det + tfm.log(β)
+
+    x = extend(tf.zeros_like(b), 0, b[..., 0])
+    z = extend(tf.zeros_like(b), 0, -r[..., 0])
+    _, x, _, _, _, log_det = tf.while_loop(
+        lambda k, *_: k < N, step,
+        (1, x, z, -r[..., 0], tf.ones_like(b[..., 0]), tf.zeros_like(b[..., 0])))
+    return x, log_det + N * tfm.log(c0[..., 0])
+
+
+def toeplitz_solve(c, y):
+    '''Solves toeplitz(c) x = y, see levinson'''
+    return levinson(c, y)[0]
+
+
+def toeplitz_mvn_log_prob(c, x):
+    '''Log density of x (..., N) under N(0, toeplitz(c)) in O(N^2)'''
+    solved, log_det = levinson(c, x)
+    N = c.shape[-1]
+    return -0.5*tf.reduce_sum(x * solved, axis=-1) - 0.5*log_det - 0.5*N*np.log(2*np.pi)
@@ -0,0 +1,154 @@
+from dataclasses import replace
+from timeit import default_timer as timer
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from reggae.data_loaders import DataHolder
+from reggae.mcmc import Options
+from reggae.mcmc.models import TranscriptionMixedSampler
+from reggae.mcmc.kernels.mixed import MixedKernel
+from reggae.utilities import logistic
+
+
+def time_function(fn, *args, repeats=10, **kwargs):
+    '''
+    Returns the mean wall time in seconds of `fn(*args, **kwargs)` over `repeats` calls.
+    One call is made beforehand so that tracing and compilation are not counted.
+    '''
+    fn(*args, **kwargs)
+    start = timer()
+    for _ in range(repeats):
+        fn(*args, **kwargs)
+    return (timer() - start) / repeats
+
+
+def chain_runner(model, num_steps, burn_in=0):
+    '''
+    Returns a tf.function which runs the sampler of `model.sample` for burn_in + num_steps
+    steps from the model's current state and returns the samples. Unlike `model.sample`,
+    which traces (and with Options.xla compiles) afresh on every call, the function is only
+    traced on its first call, so later calls time the steps alone.
+    '''
+    kernels = [param.kernel for param in model.active_params]
+    send_all_states = [param.requires_all_states for param in model.active_params]
+    current_state = [param.value for param in model.active_params]
+    mixed_kern = MixedKernel(kernels, send_all_states, burn_in + num_steps, xla=model.options.xla)
+    if model.options.xla:
+        mixed_kern.check_xla(current_state)
+
+    @tf.function
+    def run_chain():
+        return tfp.mcmc.sample_chain(num_results=num_steps,
+                                     num_burnin_steps=burn_in,
+                                     current_state=current_state,
+                                     kernel=mixed_kern,
+                                     trace_fn=None)
+    return run_chain
+
+
+def time_sampler_step(model, num_steps=20, repeats=3):
+    '''
+    Estimates the time per MCMC step of the model's sampler, averaged over `repeats` runs of
+    num_steps after an untimed run which traces and compiles the chain (see chain_runner).
+    '''
+    return time_function(chain_runner(model, num_steps), repeats=repeats) / num_steps
+
+
+def benchmark_xla(data: DataHolder, options: Options, num_steps=20, repeats=10):
+    '''
+    Compares the XLA-compiled likelihood and sampler (`Options.xla`) against the tf.function path.
+    Returns a dict mapping 'tf.function' and 'xla' to the mean seconds per `likelihood.genes`
+    call and per sampler step.
+    '''
+    timings = dict()
+    for name, xla in [('tf.function', False), ('xla', True)]:
+        model = TranscriptionMixedSampler(data, replace(options, xla=xla))
+        state = [param.value for param in model.active_params]
+        timings[name] = {
+            'genes': time_function(model.likelihood.genes, state, model.state_indices, repeats=repeats),
+            'step': time_sampler_step(model, num_steps=num_steps),
+        }
+    for name, timing in timings.items():
+        print(f'{name}:\t genes {1e3*timing["genes"]:.03f}ms\t step {1e3*timing["step"]:.03f}ms')
+    return timings
+
+
+def benchmark_latent_samplers(data: DataHolder, options: Options, T=500, burn_in=100):
+    '''
+    Compares the effective samples per second of the latents under the Metropolis
+    LatentKernel and the EllipticalSliceKernel (`Options.latent_sampler`), with the kernel
+    parameters in their own block. The chain is run once untimed to trace it (see chain_runner).
+    Returns a dict mapping each sampler to the min and mean effective sample size of the
+    latents over replicates, TFs and time points, per second of sampling.
+    '''
+    report = dict()
+    for sampler in ['metropolis', 'ess']:
+        model = TranscriptionMixedSampler(data, replace(options, joint_latent=False, latent_sampler=sampler))
+        run_chain = chain_runner(model, T, burn_in=burn_in)
+        run_chain()
+        start = timer()
+        samples = run_chain()
+        seconds = timer() - start
+        fbar = samples[model.state_indices['latents']]
+        if model.options.whitened_latents:
+            fbar = model.likelihood.colour_latents(fbar, samples[model.state_indices['kernel_params']])
+        ess = tfp.mcmc.effective_sample_size(model.likelihood.latents_on_grid(fbar)).numpy()
+        report[sampler] = {'min': np.min(ess) / seconds, 'mean': np.mean(ess) / seconds}
+    for sampler, ess in report.items():
+        print(f'{sampler}:\t min ESS/s {ess["min"]:.03f}\t mean ESS/s {ess["mean"]:.03f}')
+    return report
+
+
+def validate_fast_decay(data: DataHolder, options: Options, decay=None):
+    '''
+    Returns the largest per-gene discrepancy of the float32 and float64 gene log-likelihoods
+    at the initial state with every gene's decay rate set to `decay`. The default puts
+    decay·τ at 100 at the end of the grid, past where exp(decay·τ) overflows float32.
+    '''
+    decay = 100/data.τ[-1] if decay is None else decay
+    log_liks = list()
+    for dtype in ['float64', 'float32']:
+        model = TranscriptionMixedSampler(data, replace(options, compute_dtype=dtype))
+        state = [param.value for param in model.active_params]
+        kbar = state[model.state_indices['kinetics']][0]
+        d_index = 2 if options.initial_conditions else 1
+        kbar = tf.concat([kbar[:, :d_index], logistic(decay*tf.ones_like(kbar[:, d_index:d_index+1])),
+                          kbar[:, d_index+1:]], axis=1)
+        log_liks.append(model.likelihood.genes(state, model.state_indices, kbar=kbar, per_gene=True))
+    return np.max(np.abs(log_liks[0] - log_liks[1]))
+
+
+def validate_precision(data: DataHolder, options: Options, T=500, burn_in=500, seed=0):
+    '''
+    Compares reduced-precision sampling (`Options.compute_dtype='float32'`) against float64.
+    Reports the gene log-likelihood discrepancy at the initial state (also with fast decay
+    rates, see validate_fast_decay) and, for each parameter block, the largest difference
+    in posterior means in units of the float64 posterior std.
+    Both chains use the same seed, so differences in the posterior are down to precision
+    alone until the chains diverge.
+    '''
+    models = dict()
+    for dtype in ['float64', 'float32']:
+        tf.random.set_seed(seed)
+        model = TranscriptionMixedSampler(data, replace(options, compute_dtype=dtype))
+        model.sample(T=T, burn_in=burn_in)
+        models[dtype] = model
+
+    state = [param.value for param in models['float64'].active_params]
+    log_liks = [models[dtype].likelihood.genes(state, models[dtype].state_indices, per_gene=True)
+                for dtype in ['float64', 'float32']]
+    report = {'genes': np.max(np.abs(log_liks[0] - log_liks[1])),
+              'genes (fast decay)': validate_fast_decay(data, options)}
+
+    results = [models[dtype].results() for dtype in ['float64', 'float32']]
+    for name in ['f', 'k', 'k_f']:
+        samples64, samples32 = getattr(results[0], name), getattr(results[1], name)
+        if samples64 is None:
+            continue
+        std = np.std(samples64, axis=0) + 1e-12
+        report[name] = np.max(np.abs(np.mean(samples64, axis=0) - np.mean(samples32, axis=0)) / std)
+    for name, discrepancy in report.items():
+        print(f'{name}:\t {discrepancy:.03e}')
+    return report
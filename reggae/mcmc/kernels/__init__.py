@@ -1,11 +1,12 @@
 from reggae.mcmc.kernels.mixed import MixedKernel
 from reggae.mcmc.kernels.delay import DelayKernel
-from reggae.mcmc.kernels.latent import LatentKernel
+from reggae.mcmc.kernels.latent import LatentKernel, EllipticalSliceKernel
 from reggae.mcmc.kernels.gibbs import GibbsKernel
 
 __all__ = [
     'MixedKernel',
     'LatentKernel',
+    'EllipticalSliceKernel',
     'DelayKernel',
     'GibbsKernel',
 ]
\ No newline at end of file
@@ -8,50 +8,57 @@ import numpy as np
 
 
 class DelayKernel(tfp.mcmc.TransitionKernel):
-    def __init__(self, likelihood, lower, upper, state_indices, prior, start_iteration=1):
+    xla_compatible = False # the categorical draw uses dynamically shaped masking
+    def __init__(self, likelihood, lower, upper, state_indices, prior, start_iteration=1, batched=True):
+        '''
+        batched: if True, all candidate delays of a TF are scored in one batched likelihood
+                 call. Otherwise they are evaluated one by one, which needs less memory.
+        '''
         self.likelihood = likelihood
         self.state_indices = state_indices
         self.lower = lower
         self.upper = upper
         self.prior = prior
         self.start_iteration = start_iteration
-        
+        self.batched = batched
+
+    def delay_log_probs(self, i, state, all_states):
+        '''Computes the unnormalised log probability of each candidate delay for TF i'''
+        num_tfs = state.shape[0]
+        Δrange = np.arange(self.lower, self.upper+1, dtype='float64')
+        mask = np.zeros((num_tfs, ), dtype='float64')
+        mask[i] = 1
+        if self.batched:
+            test_states = (1-mask) * state + mask * Δrange[:, None]
+            return self.likelihood.genes(
+                all_states=all_states,
+                state_indices=self.state_indices,
+                Δ=test_states,
+            ) + self.prior.log_prob(Δrange)
+
+        probs = list()
+        for Δ in Δrange:
+            test_state = (1-mask) * state + mask * Δ
+            probs.append(tf.reduce_sum(self.likelihood.genes(
+                all_states=all_states, 
+                state_indices=self.state_indices,
+                Δ=test_state,
+            )) + tf.reduce_sum(self.prior.log_prob(Δ)))
+        return tf.stack(probs)
+
     def one_step(self, current_state, previous_kernel_results, all_states):
         iteration_number = previous_kernel_results.target_log_prob[0] #just roll with it
 
         def proceed():
             num_tfs = current_state.shape[0]
             new_state = current_state
-            Δrange = np.arange(self.lower, self.upper+1, dtype='float64')
             Δrange_tf = tf.range(self.lower, self.upper+1, dtype='float64')
             for i in range(num_tfs):
                 # Generate normalised cumulative distribution
-                probs = list()
                 mask = np.zeros((num_tfs, ), dtype='float64')
                 mask[i] = 1
-                
-                for Δ in Δrange:
-                    test_state = (1-mask) * new_state + mask * Δ
-
-                    # if j == 0:
-                    #     cumsum.append(tf.reduce_sum(self.likelihood.genes(
-                    #         all_states=all_states, 
-                    #         state_indices=self.state_indices,
-                    #         Δ=test_state,
-                    #     )) + tf.reduce_sum(self.prior.log_prob(Δ)))
-                    # else:
-
-                    probs.append(tf.reduce_sum(self.likelihood.genes(
-                        all_states=all_states, 
-                        state_indices=self.state_indices,
-                        Δ=test_state,
-                    )) + tf.reduce_sum(self.prior.log_prob(Δ)))
-                # curri = tf.cast(current_state[i], 'int64')
-                # start_index = tf.reduce_max([self.lower, curri-2])
-                # probs = tf.gather(probs, tf.range(start_index, 
-                #                                   tf.reduce_min([self.upper+1, curri+3])))
-
-                probs =  tf.stack(probs) - tfm.reduce_max(probs)
+                probs = self.delay_log_probs(i, new_state, all_states)
+                probs = probs - tfm.reduce_max(probs)
                 probs = tfm.exp(probs)
                 probs = probs / tfm.reduce_sum(probs)
                 cumsum = tfm.cumsum(probs)
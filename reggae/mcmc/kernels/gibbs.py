@@ -6,7 +6,8 @@ from reggae.mcmc.results import GenericResults
 
 
 class GibbsKernel(tfp.mcmc.TransitionKernel):
-    
+    xla_compatible = False # XLA has no stateful gamma sampler
+
     def __init__(self, data, options, likelihood, prior, state_indices, sq_diff_fn):
         self.data = data
         self.options = options
@@ -1,10 +1,12 @@
 import tensorflow as tf
+from tensorflow import math as tfm
 from tensorflow_probability import distributions as tfd
 
 from reggae.mcmc.kernels.mh import MetropolisKernel
-from reggae.mcmc.kernels.wrappers import ESSWrapper
 from reggae.gp.std_kernels import GPKernelSelector
-from reggae.utilities import jitter_cholesky, logit, add_diag
+from reggae.gp.toeplitz import toeplitz_matvec, toeplitz_sample, toeplitz_solve
+from reggae.gp.state_space import state_space_sample, state_space_posterior_mean
+from reggae.utilities import jitter_cholesky, LRUCache
 from reggae.mcmc.results import GenericResults
 
 import numpy as np
@@ -27,11 +29,23 @@ class LatentKernel(MetropolisKernel):
         self.tf_mrna_present = options.tf_mrna_present
         self.state_indices = state_indices
         self.num_replicates = data.f_obs.shape[0]
+        N_p = kernel_selector.N_p
         self.step_fn = self.f_one_step
-        self.calc_prob_fn = self.f_calc_prob
+        self.calc_prob_fn = self.latent_log_lik
+        # Only the dense proposals factorise N_p x N_p covariances, so only they allocate caches
+        self.factor_cache = None
         if options.joint_latent:
             self.step_fn = self.joint_one_step
             self.calc_prob_fn = self.joint_calc_prob
+            # Keyed on (hyperparameters of one TF, step size), holding the current and proposed states
+            self.factor_cache = LRUCache((2 + N_p,), [(N_p, N_p)]*3, size=4*self.num_tfs)
+        elif options.latent_sampler == 'metropolis' and not (
+                options.whitened_latents or kernel_selector.toeplitz or kernel_selector.state_space):
+            # Proposal factorisations keyed on (hyperparameters, step size)
+            factor_shape = (self.num_tfs, N_p, N_p)
+            self.factor_cache = LRUCache((2*self.num_tfs + N_p,), [factor_shape, factor_shape])
+        if self.factor_cache is not None:
+            kernel_selector.enable_cache()
             
         super().__init__(step_size, tune_every=100)
 
@@ -39,109 +53,141 @@ class LatentKernel(MetropolisKernel):
         return self.step_fn(current_state, previous_kernel_results, all_states)
 
     def f_one_step(self, current_state, previous_kernel_results, all_states):
-        old_probs = list()
-        new_state = tf.identity(current_state)
-
-        # MH
         kernel_params = (all_states[self.state_indices['kernel_params']][0], all_states[self.state_indices['kernel_params']][1])
-        m, K = self.fbar_prior_params(*kernel_params)
-        for r in range(self.num_replicates):
-            # Gibbs step
-            fbar = current_state[r]
-            z_i = tfd.MultivariateNormalDiag(fbar, self.step_size).sample()
-            fstar = tf.zeros_like(fbar)
-
-            for i in range(self.num_tfs):
-                invKsigmaK = tf.matmul(tf.linalg.inv(K[i]+tf.linalg.diag(self.step_size)), K[i]) # (C_i + hI)C_i
-                L = jitter_cholesky(K[i]-tf.matmul(K[i], invKsigmaK))
-                c_mu = tf.matmul(z_i[i, None], invKsigmaK)
-                fstar_i = tf.matmul(tf.random.normal((1, L.shape[0]), dtype='float64'), L) + c_mu
-                mask = np.zeros((self.num_tfs, 1), dtype='float64')
-                mask[i] = 1
-                fstar = (1-mask) * fstar + mask * fstar_i
-
-            mask = np.zeros((self.num_replicates, 1, 1), dtype='float64')
-            mask[r] = 1
-            test_state = (1-mask) * new_state + mask * fstar
-
-            new_prob = self.calc_prob_fn(test_state, all_states)
-            old_prob = self.calc_prob_fn(new_state, all_states)
-            #previous_kernel_results.target_log_prob #tf.reduce_sum(old_m_likelihood) + old_f_likelihood
-
-            is_accepted = self.metropolis_is_accepted(new_prob, old_prob)
-            
-            prob = tf.cond(tf.equal(is_accepted, tf.constant(True)), lambda:new_prob, lambda:old_prob)
-
-
-            new_state = tf.cond(tf.equal(is_accepted, tf.constant(False)),
-                                lambda:new_state, lambda:test_state)
-        return new_state, prob, is_accepted[0]
-
+        # Gibbs step: propose every replicate and TF at once
+        z = tfd.MultivariateNormalDiag(current_state, self.step_size).sample()
+        if self.options.whitened_latents:
+            # The prior of the whitened latents is N(0, I), so the conditional is elementwise
+            ε = tf.random.normal(current_state.shape, dtype='float64')
+            fstar = z / (1 + self.step_size) + tfm.sqrt(self.step_size / (1 + self.step_size)) * ε
+        elif self.kernel_selector.toeplitz:
+            fstar = self.toeplitz_proposal(z, kernel_params)
+        elif self.kernel_selector.state_space:
+            fstar = self.state_space_proposal(z, kernel_params)
+        else:
+            K = self.kernel_selector.covariance(*kernel_params)
+            invKsigmaK, L = self.proposal_factors(K, *kernel_params)
+            c_mu = tf.linalg.matvec(invKsigmaK, z, transpose_a=True)
+            ε = tf.random.normal(current_state.shape, dtype='float64')
+            fstar = tf.linalg.matvec(L, ε, transpose_a=True) + c_mu
+
+        # MH: the likelihood factorises over replicates, so each is accepted independently
+        new_prob = self.latent_log_lik(fstar, all_states, per_replicate=True)
+        old_prob = self.latent_log_lik(current_state, all_states, per_replicate=True)
+        is_accepted = self.metropolis_is_accepted(new_prob, old_prob, shape=old_prob.shape)
+        new_state = tf.where(is_accepted[:, None, None], fstar, current_state)
+        prob = tf.reduce_sum(tf.where(is_accepted, new_prob, old_prob))
+        return new_state, prob, is_accepted
+
+    def toeplitz_proposal(self, z, kernel_params):
+        '''
+        Draws from the same conditional as the dense proposal, N(K(K + S)^-1 z, K - K(K + S)^-1 K),
+        for a Toeplitz K, by conditioning a prior draw f_0 on z (Matheron's rule):
+        f = f_0 + K(K + S)^-1 (z - f_0 - e) with f_0 ~ N(0, K), e ~ N(0, S). f_0 is drawn by
+        circulant embedding and the solve uses the Levinson recursion, so no N_p x N_p matrix
+        is formed unless the embedding cannot be made positive semi-definite (see toeplitz_sample).
+        The step sizes are uniform over τ (as initialised and tuned), so K + S is Toeplitz.
+        '''
+        c = self.kernel_selector.rbf_row(*kernel_params)
+        f_0 = toeplitz_sample(lambda num: self.kernel_selector.rbf_row(*kernel_params, num),
+                              c.shape[-1], (self.num_replicates,))
+        e = tf.random.normal(z.shape, dtype='float64') * tfm.sqrt(self.step_size)
+        c_sum = c + self.step_size[0] * tf.one_hot(0, c.shape[-1], dtype='float64')
+        return f_0 + toeplitz_matvec(c, toeplitz_solve(c_sum, z - f_0 - e))
+
+    def state_space_proposal(self, z, kernel_params):
+        '''
+        Draws from the conditional of the dense proposal for a Matérn K by Matheron's rule, as in
+        toeplitz_proposal: the prior draw f_0 simulates the kernel's SDE and K(K + S)^-1 is the
+        Kalman smoother with observation variances S, so the cost is linear in N_p.
+        '''
+        F, P = self.kernel_selector.sde(*kernel_params)
+        τ = self.kernel_selector.τ
+        f_0 = state_space_sample(F, P, τ, (self.num_replicates,))
+        e = tf.random.normal(z.shape, dtype='float64') * tfm.sqrt(self.step_size)
+        return f_0 + state_space_posterior_mean(F, P, τ, z - f_0 - e, self.step_size)
+
+    def proposal_factors(self, K, param_0, param_1):
+        '''
+        Returns (K_i + S)^-1 K_i and chol(K_i - K_i(K_i + S)^-1 K_i), each (I, N_p, N_p), for the
+        conditional proposal with step size S. These only depend on the hyperparameters and the
+        step size, so they are cached across replicates and iterations.
+        '''
+        def factorise():
+            invKsigmaK = tf.matmul(tf.linalg.inv(K+tf.linalg.diag(self.step_size)), K) # (C_i + hI)C_i
+            L = jitter_cholesky(K-tf.matmul(K, invKsigmaK))
+            return invKsigmaK, L
+        key = tf.concat([param_0, param_1, self.step_size], axis=0)
+        return self.factor_cache(key, factorise)
 
     @tf.function
     def joint_one_step(self, current_state, previous_kernel_results, all_states):
-        new_state = tf.identity(current_state[0])
-        new_params = []
-        S = tf.linalg.diag(self.step_size)
-        # MH
-        m, K = self.fbar_prior_params(current_state[1], current_state[2])
-        N_p = K.shape[-1]
-        K = K+tf.linalg.diag(1e-7*tf.ones(N_p, dtype='float64'))
+        fbar = current_state[0]
+        old_hyp = [current_state[1], current_state[2]]
 
         # Propose new params
         v = self.kernel_selector.proposal(0, current_state[1]).sample()
         l2 = self.kernel_selector.proposal(1, current_state[2]).sample()
-        m_, K_ = self.fbar_prior_params(v, l2)
-        K_ = K_+tf.linalg.diag(1e-7*tf.ones(N_p, dtype='float64'))
-        iK = tf.linalg.inv(K)
-        iK_ = tf.linalg.inv(K_)
-        U_invR = tf.linalg.cholesky(add_diag(iK, 1/S))
-        U_invR = tf.transpose(U_invR, [0, 2, 1])
-        U_invR_ = jitter_cholesky(add_diag(iK_, 1/S))
-        U_invR_ = tf.transpose(U_invR_, [0, 2, 1])
         new_hyp = [v, l2]
-        old_hyp = [current_state[1], current_state[2]]
+        L_B, C, L_Σ = self.joint_factors(*old_hyp)
+        L_B_, C_, L_Σ_ = self.joint_factors(*new_hyp)
+
+        # Gibbs step: draw surrogate data g ~ N(f, S) for all replicates at once, then map
+        # f to its whitened residual under the current conditional f | g and back under the proposed
+        g = tfd.MultivariateNormalDiag(fbar, self.step_size).sample()
+        μ, g_prob = self.condition_on_surrogate(L_B, C, g)
+        μ_, g_prob_ = self.condition_on_surrogate(L_B_, C_, g)
+        nu = tf.linalg.triangular_solve(L_Σ, tf.expand_dims(fbar - μ, -1))
+        f = μ_ + tf.squeeze(tf.matmul(L_Σ_, nu), -1)
+
+        # Test each TF individually against the current state of the others
+        new_lik, old_lik = self.tf_local_log_lik(f, all_states)
+        new_prob = new_lik + self.hyper_log_prob(new_hyp, old_hyp) + g_prob_
+        old_prob = old_lik + self.hyper_log_prob(old_hyp, new_hyp) + g_prob
+        is_accepted = self.metropolis_is_accepted(new_prob, old_prob, shape=(self.num_tfs,))
+
+        new_state = tf.where(is_accepted[:, None], f, fbar)
+        new_hyp = [tf.where(is_accepted, new, old) for new, old in zip(new_hyp, old_hyp)]
+        return [new_state, *new_hyp], f64(0), is_accepted
+
+    def joint_factors(self, param_0, param_1):
+        '''
+        Returns the factors of the surrogate data update for the given hyperparameters, each
+        (I, N_p, N_p): L_B = chol(K + S), C = L_B^-1 K and L_Σ = chol(K(K + S)^-1 S), the Cholesky
+        factor of the covariance of f given surrogate data. Only Cholesky factorisations and
+        triangular solves are used. The factors are cached per TF, so those of the current
+        state are reused from the step which proposed them.
+        '''
+        K = self.kernel_selector.covariance(param_0, param_1)
+        N_p = K.shape[-1]
+        K = K+tf.linalg.diag(1e-7*tf.ones(N_p, dtype='float64'))
+        S = tf.linalg.diag(self.step_size)
 
-        # Gibbs step
-        fbar = new_state
-        for r in range(self.num_replicates):
-            fbar = new_state[r]
-
-            gg = tfd.MultivariateNormalDiag(fbar, self.step_size).sample()
-
-            Sinv_g = gg / self.step_size
-
-            nu = tf.linalg.matvec(U_invR, fbar) - tf.squeeze(tf.linalg.solve(tf.transpose(U_invR, [0, 2, 1]), tf.expand_dims(Sinv_g, -1)), -1)
-            f = tf.linalg.solve(U_invR_, tf.expand_dims(nu, -1)) + tf.linalg.cholesky_solve(tf.transpose(U_invR_, [0, 2, 1]), tf.expand_dims(Sinv_g, -1))
-            f = tf.squeeze(f, -1)
-
-            mask = np.zeros((self.num_replicates, 1, 1), dtype='float64')
-            mask[r] = 1
-            new_state = (1-mask) * new_state + mask * f
-        
-        test_state = tf.zeros((self.num_replicates, self.num_tfs, N_p), dtype='float64')
-
-        for i in range(self.num_tfs): # Test each tf individually
-            mask = np.zeros((self.num_replicates, self.num_tfs, 1), dtype='float64')
-            hyp_mask = np.zeros((self.num_tfs,), dtype='float64')
-            hyp_mask[i] = 1
-            mask[:, i] = 1
-            test_state = (1-mask) * current_state[0] + mask * new_state
-
-            new_prob = self.calc_prob_fn(test_state, new_hyp, old_hyp, all_states)
-            old_prob = self.calc_prob_fn(current_state[0], old_hyp, new_hyp, all_states) #previous_kernel_results.target_log_prob 
-            is_accepted = self.metropolis_is_accepted(new_prob, old_prob)
-            if not is_accepted[0]:
-                new_state = (1-mask) * new_state + mask * current_state[0]
-                new_hyp[0] = (1-hyp_mask) * new_hyp[0] + hyp_mask * current_state[1]
-                new_hyp[1] = (1-hyp_mask) * new_hyp[1] + hyp_mask * current_state[2]
-            # prob = tf.cond(tf.equal(is_accepted, tf.constant(True)), lambda:new_prob, lambda:old_prob)
-
-            # new_state = tf.cond(tf.equal(is_accepted, tf.constant(False)),
-            #                     lambda:current_state[0], lambda:new_state)
-        # new_params = tf.cond(tf.equal(is_accepted, tf.constant(False)),
-        #                         lambda:[current_state[1], current_state[2]], lambda:[v, l2])
-        return [new_state, *new_hyp], f64(0), is_accepted[0]
+        def factorise(K_i):
+            L_B = tf.linalg.cholesky(K_i + S)
+            C = tf.linalg.triangular_solve(L_B, K_i)
+            D = tf.linalg.triangular_solve(L_B, S)
+            Σ = tf.matmul(C, D, transpose_a=True) # K(K + S)^-1 S, free of cancellation
+            L_Σ = jitter_cholesky(0.5*(Σ + tf.transpose(Σ)))
+            return L_B, C, L_Σ
+
+        factors = list()
+        for i in range(self.num_tfs):
+            key = tf.concat([tf.stack([param_0[i], param_1[i]]), self.step_size], axis=0)
+            factors.append(self.factor_cache(key, lambda K_i=K[i]: factorise(K_i)))
+        return [tf.stack(factor) for factor in zip(*factors)]
+
+    def condition_on_surrogate(self, L_B, C, g):
+        '''
+        Returns the mean K(K + S)^-1 g of f given surrogate data g (R, I, N_p) and the
+        log marginal density of g under N(0, K + S), summed over replicates (I,).
+        '''
+        a = tf.linalg.triangular_solve(L_B, tf.expand_dims(g, -1))
+        μ = tf.squeeze(tf.matmul(C, a, transpose_a=True), -1)
+        log_prob = -0.5*tf.reduce_sum(tf.square(a), axis=[-2, -1]) \
+                   - tf.reduce_sum(tf.math.log(tf.linalg.diag_part(L_B)), axis=-1) \
+                   - 0.5*g.shape[-1]*np.log(2*np.pi)
+        return μ, tf.reduce_sum(log_prob, axis=0)
 
     def _joint_one_step(self, current_state, previous_kernel_results, all_states):
         # Untransformed tf mRNA vectors F (Step 1)
@@ -190,97 +236,142 @@ class LatentKernel(MetropolisKernel):
 
         return [new_state, *new_params], prob, is_accepted[0]
     
-    def f_calc_prob(self, fstar, all_states):
-        new_m_likelihood = self.likelihood.genes(
-            all_states,
-            self.state_indices,
-            fbar=fstar,
-        )
-        new_f_likelihood = tf.cond(tf.equal(self.tf_mrna_present, tf.constant(True)), 
-                                   lambda:tf.reduce_sum(self.likelihood.tfs(
-                                       1e-6*tf.ones(self.num_tfs, dtype='float64'), # TODO
-                                       fstar
-                                   )), lambda:f64(0))
-        new_prob = tf.reduce_sum(new_m_likelihood) + new_f_likelihood
-        return new_prob
-
-    def joint_calc_prob(self, fstar, new_hyp, old_hyp, all_states):
-        new_m_likelihood = self.likelihood.genes(
+    def latent_log_lik(self, fstar, all_states, per_replicate=False, kernel_params=None):
+        '''
+        Computes the log-likelihood of the genes and TFs given latents fstar (..., R, I, N_p),
+        returning the batch shape of fstar, or (..., R) if per_replicate is True.
+        Whitened latents are coloured by kernel_params, by default those in all_states.
+        '''
+        if self.options.whitened_latents:
+            cached = kernel_params is None # overridden kernel_params may be differentiated
+            if cached:
+                kernel_params = all_states[self.state_indices['kernel_params']]
+            fstar = self.likelihood.colour_latents(fstar, kernel_params, cached=cached)
+        log_lik = self.likelihood.genes(
             all_states,
             self.state_indices,
             fbar=fstar,
+            per_replicate=per_replicate,
         )
-        σ2_f = 1e-6*tf.ones(self.num_tfs, dtype='float64')
-        if 'σ2_f' in self.state_indices:
-            σ2_f = all_states[self.state_indices['σ2_f']]
-
-        new_f_likelihood = tf.cond(tf.equal(self.tf_mrna_present, tf.constant(True)), 
-                                   lambda:tf.reduce_sum(self.likelihood.tfs(
-                                       σ2_f,
-                                       fstar
-                                   )), lambda:f64(0))
-        new_prob = tf.reduce_sum(new_m_likelihood) + new_f_likelihood
-
-        new_prob += tf.reduce_sum(
-            self.kernel_selector.proposal(0, new_hyp[0]).log_prob(old_hyp[0]) + \
-            self.kernel_selector.proposal(1, new_hyp[1]).log_prob(old_hyp[1])
-        )
+        if self.tf_mrna_present:
+            σ2_f = 1e-6*tf.ones(self.num_tfs, dtype='float64')
+            if 'σ2_f' in self.state_indices:
+                σ2_f = all_states[self.state_indices['σ2_f']]
+            log_lik += self.likelihood.tfs(σ2_f, fstar, per_replicate=per_replicate)
+        return log_lik
+
+    def tf_local_log_lik(self, fstar, all_states):
+        '''
+        Computes the log-likelihood with the latents of each TF i in turn replaced by fstar[:, i],
+        shape (I,), and the current log-likelihood. Only the terms involving TF i are recomputed.
+        '''
+        fbar = all_states[self.state_indices['latents']][0]
+        new_lik, old_lik = self.likelihood.tf_local_genes(all_states, self.state_indices, fstar)
+        if self.tf_mrna_present:
+            σ2_f = 1e-6*tf.ones(self.num_tfs, dtype='float64')
+            if 'σ2_f' in self.state_indices:
+                σ2_f = all_states[self.state_indices['σ2_f']]
+            # The TF likelihood factorises over TFs
+            old_f_lik = self.likelihood.tfs(σ2_f, fbar, per_tf=True)
+            new_lik += tf.reduce_sum(old_f_lik) - old_f_lik + self.likelihood.tfs(σ2_f, fstar, per_tf=True)
+            old_lik += tf.reduce_sum(old_f_lik)
+        return new_lik, old_lik
+
+    def hyper_log_prob(self, new_hyp, old_hyp):
+        '''
+        Computes the log prior of new_hyp plus the log density of proposing old_hyp from it,
+        for each TF, shape (I,).
+        '''
+        log_prob = self.kernel_selector.proposal(0, new_hyp[0]).log_prob(old_hyp[0]) + \
+                   self.kernel_selector.proposal(1, new_hyp[1]).log_prob(old_hyp[1])
         if self.options.kernel_exponential:
             new_hyp = [tf.exp(new_hyp[0]), tf.exp(new_hyp[1])]
 
-        new_prob += tf.reduce_sum(
-            self.kernel_priors[0].log_prob(new_hyp[0]) + \
-            self.kernel_priors[1].log_prob(new_hyp[1])
-        )
+        log_prob += self.kernel_priors[0].log_prob(new_hyp[0]) + \
+                    self.kernel_priors[1].log_prob(new_hyp[1])
+        return log_prob
+
+    def joint_calc_prob(self, fstar, new_hyp, old_hyp, all_states):
+        new_prob = self.latent_log_lik(fstar, all_states)
+        new_prob += tf.reduce_sum(self.hyper_log_prob(new_hyp, old_hyp))
         return new_prob
 
     def bootstrap_results(self, init_state, all_states):
+        if not self.options.joint_latent:
+            prob = self.calc_prob_fn(init_state, all_states)
+            return GenericResults(prob, tf.ones(self.num_replicates, dtype='bool'))
         prob = self.calc_prob_fn(init_state[0], [init_state[1], init_state[2]], 
                                  [init_state[1], init_state[2]], all_states)
 
-        return GenericResults(prob, True)
+        return GenericResults(prob, tf.ones(self.num_tfs, dtype='bool'))
     
     def is_calibrated(self):
         return True
 
 
-class ESSBuilder:
-    def __init__(self, data, state_indices, kernel_selector):
-        self.state_indices = state_indices
-        self.kernel_selector = kernel_selector
-        self.num_replicates = data.f_obs.shape[0]
-        self.num_tfs = data.f_obs.shape[1]
+class EllipticalSliceKernel(LatentKernel):
+    '''
+    Elliptical slice sampler (Murray, Adams & MacKay, 2010) for the latents when the kernel
+    parameters are sampled in their own block (joint_latent=False). Each step draws ν from the
+    GP prior and moves along the ellipse f cos θ + ν sin θ, shrinking the angle until the
+    likelihood exceeds a slice threshold. There is no step size to tune and every step moves.
+    The likelihood factorises over replicates, so each replicate has its own slice and angle
+    and all replicates (and TFs) are proposed in one batched likelihood call per shrink.
+    The prior Cholesky factors come from the kernel selector's Cholesky cache; Toeplitz priors
+    are drawn by circulant embedding, Matérn priors by simulating their SDE and whitened
+    latents (Options.whitened_latents) from N(0, I).
+    Args:
+        max_shrinks: replicates whose slice has not been hit after this many shrinks keep their state.
+    '''
+    def __init__(self, data, options, likelihood, kernel_selector, state_indices, max_shrinks=100):
+        N_p = kernel_selector.N_p
+        super().__init__(data, options, likelihood, kernel_selector, state_indices,
+                         tf.ones(N_p, dtype='float64'))
+        self.max_shrinks = max_shrinks
+        if not (options.whitened_latents or kernel_selector.toeplitz or kernel_selector.state_space):
+            kernel_selector.enable_cache(cholesky=True)
+
+    def prior_sample(self, shape, kernel_params):
+        '''Draws ν ~ N(0, K) of shape (R, I, N_p) for the given kernel parameters'''
+        ε = tf.random.normal(shape, dtype='float64')
+        if self.options.whitened_latents:
+            return ε
+        if self.kernel_selector.toeplitz:
+            return toeplitz_sample(lambda num: self.kernel_selector.rbf_row(*kernel_params, num),
+                                   shape[-1], shape[:1])
+        if self.kernel_selector.state_space:
+            return state_space_sample(*self.kernel_selector.sde(*kernel_params), self.kernel_selector.τ, shape[:1])
+        L = self.kernel_selector.cholesky(*kernel_params, cached=True)
+        return tf.linalg.matvec(L, ε)
 
-    def normal_sampler_fn_fn(self, all_states):
-        def normal_sampler_fn(seed):
-            p1, p2 = all_states[self.state_indices['kernel_params']]
-            m, K = self.kernel_selector()(logit(p1), logit(p2))
-            m = tf.zeros((self.num_replicates, self.num_tfs, self.N_p), dtype='float64')
-            K = tf.stack([K for _ in range(3)], axis=0)
-            jitter = tf.linalg.diag(1e-8 *tf.ones(self.N_p, dtype='float64'))
-            z = tfd.MultivariateNormalTriL(loc=m, 
-                                scale_tril=tf.linalg.cholesky(K+jitter)).sample(seed=seed)
-            # tf.print(z)
-            return z
-        return normal_sampler_fn
-
-    def f_log_prob_fn(self, all_states):
-        def f_log_prob(fstar):
-            # print(all_states)
-            new_m_likelihood = self.likelihood.genes(
-                all_states,
-                self.state_indices,
-                fbar=fstar,
-            )
-            σ2_f = 1e-6*tf.ones(self.num_tfs, dtype='float64')
-            # if 'σ2_f' in self.state_indices:
-            #     σ2_f = all_states[self.state_indices['σ2_f']]
-
-            new_f_likelihood = tf.cond(tf.equal(self.options.tf_mrna_present, tf.constant(True)), 
-                                    lambda:tf.reduce_sum(self.likelihood.tfs(
-                                        σ2_f,
-                                        fstar
-                                    )), lambda:f64(0))
-            return tf.reduce_sum(new_m_likelihood) + new_f_likelihood
-        return f_log_prob
-    latents_kernel = ESSWrapper(normal_sampler_fn_fn, f_log_prob_fn)
+    @tf.function
+    def one_step(self, current_state, previous_kernel_results, all_states):
+        kernel_params = all_states[self.state_indices['kernel_params']]
+        ν = self.prior_sample(current_state.shape, kernel_params)
+        log_lik = self.latent_log_lik(current_state, all_states, per_replicate=True)
+        threshold = log_lik + tfm.log(tf.random.uniform(log_lik.shape, dtype='float64'))
+        θ = tf.random.uniform(log_lik.shape, maxval=2*np.pi, dtype='float64')
+        bracket = (θ - 2*np.pi, θ)
+
+        def rotate(θ):
+            return current_state*tfm.cos(θ)[:, None, None] + ν*tfm.sin(θ)[:, None, None]
+
+        def shrink(done, θ, θ_min, θ_max, new_state, new_log_lik):
+            fstar = rotate(θ)
+            fstar_log_lik = self.latent_log_lik(fstar, all_states, per_replicate=True)
+            accept = tfm.logical_and(tfm.logical_not(done), fstar_log_lik > threshold)
+            new_state = tf.where(accept[:, None, None], fstar, new_state)
+            new_log_lik = tf.where(accept, fstar_log_lik, new_log_lik)
+            done = tfm.logical_or(done, accept)
+            # Shrink the bracket towards the current state (θ = 0) and redraw
+            θ_min = tf.where(θ < 0, θ, θ_min)
+            θ_max = tf.where(θ < 0, θ_max, θ)
+            θ = tf.where(done, θ, tf.random.uniform(θ.shape, dtype='float64')*(θ_max - θ_min) + θ_min)
+            return done, θ, θ_min, θ_max, new_state, new_log_lik
+
+        done = tf.zeros(log_lik.shape, dtype='bool')
+        done, _, _, _, new_state, new_log_lik = tf.while_loop(
+            lambda done, *_: tfm.logical_not(tf.reduce_all(done)),
+            shrink, (done, θ, *bracket, current_state, log_lik),
+            maximum_iterations=self.max_shrinks)
+        return new_state, GenericResults(tf.reduce_sum(new_log_lik), done, previous_kernel_results.acc_iter)
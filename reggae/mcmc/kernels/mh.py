@@ -2,6 +2,7 @@ from abc import abstractmethod
 
 import tensorflow as tf
 import tensorflow_probability as tfp
+from tensorflow_probability import distributions as tfd
 from tensorflow import math as tfm
 
 from reggae.mcmc.results import GenericResults
@@ -14,10 +15,11 @@ class MetropolisKernel(tfp.mcmc.TransitionKernel):
     def __init__(self, step_size, tune_every=20):
         self.step_size = tf.Variable(step_size)
         self.tune_every = tune_every
+        self.print_tuning = True # disabled by MixedKernel for XLA-compiled kernels
 
-    def metropolis_is_accepted(self, new_log_prob, old_log_prob):
+    def metropolis_is_accepted(self, new_log_prob, old_log_prob, shape=(1,)):
         alpha = tf.math.exp(new_log_prob - old_log_prob)
-        return tf.random.uniform((1,), dtype='float64') < tf.math.minimum(f64(1), alpha)
+        return tf.random.uniform(shape, dtype='float64') < tf.math.minimum(f64(1), alpha)
     #     if is_tensor(alpha):
     #         alpha = alpha.numpy()
     #     return not np.isnan(alpha) and random.random() < min(1, alpha)
@@ -28,8 +30,8 @@ class MetropolisKernel(tfp.mcmc.TransitionKernel):
         acc_rate, iteration = previous_kernel_results.acc_iter
         acc = acc_rate*iteration
         iteration += f64(1)
-        acc_rate = tf.cond(tf.equal(is_accepted, tf.constant(True)), 
-                        lambda: (acc+1)/iteration, lambda: acc/iteration)
+        # is_accepted may be a vector of independent decisions, e.g. one per gene
+        acc_rate = (acc + tf.reduce_mean(tf.cast(is_accepted, 'float64')))/iteration
         # tf.print(acc_rate, iteration)
         tf.cond(tf.equal(tfm.floormod(iteration, self.tune_every), 0), lambda: self.tune(acc_rate), lambda:None)
 
@@ -50,61 +52,107 @@ class MetropolisKernel(tfp.mcmc.TransitionKernel):
             ],
             default=lambda:self.step_size
         ))
-        tf.print('Updating step_size', self.step_size[0], 'due to acc rate', acc_rate)
+        if self.print_tuning:
+            tf.print('Updating step_size', self.step_size[0], 'due to acc rate', acc_rate)
     
     def is_calibrated(self):
         return True
 
 
 
-class KbarKernel(MetropolisKernel):
-    def __init__(self, likelihood, prop_dist, prior_dist, num_genes, state_indices):
-        self.prop_dist = prop_dist
-        self.prior_dist = prior_dist
-        self.num_genes = num_genes
+class KineticsKernel(MetropolisKernel):
+    '''
+    Random walk Metropolis kernel for the kinetics block [kbar, (k_fbar), (wbar, w_0bar)].
+    Given the latents the genes are conditionally independent, so the gene-specific parameters
+    are proposed for all genes at once and each gene is accepted or rejected independently using
+    the per-gene likelihood. The TF parameters k_fbar are shared by all genes and so receive a
+    joint Metropolis step. The cost per step is therefore a fixed number of likelihood calls.
+    For a sparse network the weights are an edge list, which is mapped to genes via the
+    likelihood's edge_genes.
+    Args:
+        log_priors: list of elementwise log prior functions aligned with the kinetics state.
+    '''
+    def __init__(self, likelihood, options, log_priors, state_indices, step_size):
         self.likelihood = likelihood
+        self.options = options
+        self.log_priors = log_priors
         self.state_indices = state_indices
-        
-    def one_step(self, current_state, previous_kernel_results, all_states):
+        self.gene_indices = [0]
+        self.tf_index = None
+        self.weights_index = None
+        if options.translation:
+            self.tf_index = 1
+        if options.weights:
+            num_params = len(log_priors)
+            self.weights_index = num_params-2
+            self.gene_indices += [num_params-2, num_params-1]
+        super().__init__(step_size, tune_every=50)
+
+    def gene_log_prob(self, state, all_states, k_fbar=None, protein=None):
+        '''
+        Computes the per-gene log posterior, shape (num_genes,).
+        k_fbar is taken from all_states unless given, in which case protein is not used.
+        '''
+        args = {'kbar': state[0]}
+        if self.options.weights:
+            args['wbar'] = state[-2]
+            args['w_0bar'] = state[-1]
+        log_prob = self.likelihood.genes(
+            all_states,
+            self.state_indices,
+            k_fbar=k_fbar,
+            per_gene=True,
+            protein=protein,
+            **args
+        )
+        for k in self.gene_indices:
+            log_prior = self.log_priors[k](state[k])
+            if self.is_edge_list(k):
+                log_prob += tf.math.unsorted_segment_sum(
+                    log_prior, self.likelihood.edge_genes, self.likelihood.num_genes)
+            else:
+                log_prob += tf.reduce_sum(tf.reshape(log_prior, (log_prior.shape[0], -1)), axis=1)
+        return log_prob
+
+    def is_edge_list(self, k):
+        return k == self.weights_index and self.likelihood.edge_genes is not None
 
-        kbar = current_state
-        kstar = tf.identity(kbar)
-        old_probs = list()
-        is_accepteds = list()
-        for j in range(self.num_genes):
-            sample = self.prop_dist(kstar[j]).sample()
-#             sample = params.kbar.constrain(sample, j)
-            kstar = tf.concat([kstar[:j], [sample], kstar[j+1:]], axis=0)
-            
-            new_prob = self.likelihood.genes(
-                all_states,
-                self.state_indices,
-                kbar=kstar, 
-            )[j] + tf.reduce_sum(self.prior_dist.log_prob(sample))
-            
-            old_prob = previous_kernel_results.target_log_prob[j] #old_m_likelihood[j] + sum(params.kbar.prior.log_prob(kbar[j]))
-
-            is_accepted = self.metropolis_is_accepted(new_prob, old_prob)
-            is_accepteds.append(is_accepted)
-            
-            prob = tf.cond(tf.equal(is_accepted, tf.constant(True)), lambda:new_prob, lambda:old_prob)
-            kstar = tf.cond(tf.equal(is_accepted, tf.constant(False)), 
-                                     lambda:tf.concat([kstar[:j], [current_state[j]], kstar[j+1:]], axis=0), lambda:kstar)
-            old_probs.append(prob)
-
-        return kstar, GenericResults(old_probs, True) #TODO not just return true
+    def _one_step(self, current_state, previous_kernel_results, all_states):
+        # The gene-wise proposals leave the latents, k_fbar and Δ unchanged
+        protein = self.likelihood.protein_from_state(all_states, self.state_indices)
+
+        # Propose gene-specific parameters for all genes at once
+        proposed = list(current_state)
+        for k in self.gene_indices:
+            proposed[k] = tfd.Normal(current_state[k], self.step_size).sample()
+        old_prob = self.gene_log_prob(current_state, all_states, protein=protein)
+        new_prob = self.gene_log_prob(proposed, all_states, protein=protein)
+
+        # Accept or reject each gene independently
+        is_accepted = self.metropolis_is_accepted(new_prob, old_prob, shape=old_prob.shape)
+        new_state = list(current_state)
+        for k in self.gene_indices:
+            if self.is_edge_list(k):
+                accept = tf.gather(is_accepted, self.likelihood.edge_genes)
+            else:
+                accept = tf.reshape(is_accepted, (-1,) + (1,)*(current_state[k].shape.rank-1))
+            new_state[k] = tf.where(accept, proposed[k], current_state[k])
+        prob = tf.where(is_accepted, new_prob, old_prob)
+
+        if self.tf_index is not None:
+            # k_fbar couples all genes so it is accepted jointly
+            k_fbar = new_state[self.tf_index]
+            k_fbarstar = tfd.Normal(k_fbar, self.step_size).sample()
+            old_tf_prob = tf.reduce_sum(prob) + tf.reduce_sum(self.log_priors[self.tf_index](k_fbar))
+            new_gene_prob = self.gene_log_prob(new_state, all_states, k_fbar=k_fbarstar)
+            new_tf_prob = tf.reduce_sum(new_gene_prob) + \
+                          tf.reduce_sum(self.log_priors[self.tf_index](k_fbarstar))
+            tf_accepted = self.metropolis_is_accepted(new_tf_prob, old_tf_prob)[0]
+            new_state[self.tf_index] = tf.where(tf_accepted, k_fbarstar, k_fbar)
+            prob = tf.where(tf_accepted, new_gene_prob, prob)
+
+        return new_state, prob, is_accepted
 
     def bootstrap_results(self, init_state, all_states):
-        probs = list()
-        for j in range(self.num_genes):
-            prob = self.likelihood.genes(
-                all_states,
-                self.state_indices,
-                kbar=init_state, 
-            )[j] + tf.reduce_sum(self.prior_dist.log_prob(init_state[j]))
-            probs.append(prob)
-
-        return GenericResults(probs, True) #TODO automatically adjust
-    
-    def is_calibrated(self):
-        return True
+        prob = self.gene_log_prob(init_state, all_states)
+        return GenericResults(prob, tf.ones(prob.shape, dtype='bool'))
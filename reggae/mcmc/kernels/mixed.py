@@ -2,16 +2,18 @@ import tensorflow as tf
 import tensorflow_probability as tfp
 
 from reggae.mcmc.results import MixedKernelResults, GenericResults
-from reggae.utilities import prog
+from reggae.utilities import prog, xla_function
 
 from inspect import signature
 
 class MixedKernel(tfp.mcmc.TransitionKernel):
-    def __init__(self, kernels, send_all_states, T, skip=None):
+    def __init__(self, kernels, send_all_states, T, skip=None, xla=False):
         '''
         send_all_states is a boolean array of size |kernels| indicating which components of the state
         have kernels whose log probability depends on the state of others, in which case MixedKernel
         will recompute the previous target_log_prob before handing it over in the `one_step` call.
+        If xla is True, each kernel's `one_step` is XLA-compiled unless the kernel sets
+        `xla_compatible = False`. See `check_xla` for falling back on kernels which fail to compile.
         '''
         self.T = T
         self.kernels = kernels
@@ -20,8 +22,34 @@ class MixedKernel(tfp.mcmc.TransitionKernel):
         self.last_m_log_lik = tf.Variable(tf.zeros((self.num_kernels)))
         self.one_step_receives_state = [len(signature(k.one_step).parameters)>2 for k in kernels]
         self.skip = skip
+        self.step_fns = [k.one_step for k in kernels]
+        if xla:
+            self.step_fns = [xla_function(k.one_step) if getattr(k, 'xla_compatible', True) else k.one_step
+                             for k in kernels]
+            for kernel, step_fn in zip(kernels, self.step_fns):
+                if step_fn != kernel.one_step and hasattr(kernel, 'print_tuning'):
+                    kernel.print_tuning = False # XLA cannot compile printing
         super().__init__()
 
+    def check_xla(self, init_state):
+        '''
+        Falls back to graph mode for any kernel whose `one_step` contains ops which XLA
+        cannot compile (e.g. printing or dynamically shaped ops). Must be called eagerly.
+        '''
+        results = self.bootstrap_results(init_state)
+        for i in range(self.num_kernels):
+            if self.step_fns[i] == self.kernels[i].one_step:
+                continue
+            args = [init_state] if self.one_step_receives_state[i] else []
+            try:
+                self.step_fns[i].experimental_get_compiler_ir(
+                    init_state[i], results.inner_results[i], *args)(stage='hlo')
+            except Exception:
+                print(f'{type(self.kernels[i]).__name__} cannot be compiled with XLA, falling back to tf.function')
+                self.step_fns[i] = self.kernels[i].one_step
+                if hasattr(self.kernels[i], 'print_tuning'):
+                    self.kernels[i].print_tuning = True
+
     def one_step(self, current_state, previous_kernel_results):
         # tf.print('running iteration')
         # if previous_kernel_results.iteration % 10:
@@ -62,7 +90,7 @@ class MixedKernel(tfp.mcmc.TransitionKernel):
 
                 # state_chained = tf.expand_dims(current_state[i], 0)
                 # print(state_chained)
-                result_state, kernel_results = self.kernels[i].one_step(
+                result_state, kernel_results = self.step_fns[i](
                     current_state[i], previous_kernel_results.inner_results[i], *args)
             except Exception as e:
                 tf.print('Failed at ', i, self.kernels[i], current_state)
@@ -94,7 +122,8 @@ class MixedKernel(tfp.mcmc.TransitionKernel):
                 results = self.kernels[i].bootstrap_results(init_state[i])
                 inner_kernels_bootstraps.append(results)
 
-            is_accepted.append(True)
+            # Kernels may accept blocks independently (e.g. per gene), so take the shape from them
+            is_accepted.append(tf.ones_like(results.is_accepted, dtype='bool'))
 
 
         return MixedKernelResults(inner_kernels_bootstraps, is_accepted, 0)
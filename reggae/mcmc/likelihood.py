@@ -2,7 +2,8 @@ import tensorflow as tf
 from tensorflow import math as tfm
 
 from reggae.data_loaders import DataHolder
-from reggae.utilities import rotate, jitter_cholesky, logit, logistic, LogisticNormal, inverse_positivity, save_object
+from reggae.utilities import jitter_cholesky, logit, QUADRATURES, xla_function, logistic, LogisticNormal, inverse_positivity, save_object
+from reggae.utilities import inducing_points, interpolation_matrix
 from reggae.mcmc import Options
 
 import numpy as np
@@ -10,75 +11,184 @@ PI = tf.constant(np.pi, dtype='float64')
 
 
 class TranscriptionLikelihood():
-    def __init__(self, data: DataHolder, options: Options):
+    def __init__(self, data: DataHolder, options: Options, kernel_selector=None):
         self.options = options
+        self.kernel_selector = kernel_selector # required to colour whitened latents
+        if options.whitened_latents and kernel_selector is not None:
+            kernel_selector.enable_cache(cholesky=True)
         self.data = data
         self.preprocessing_variance = options.preprocessing_variance
         self.num_genes = data.m_obs.shape[1]
         self.num_tfs = data.f_obs.shape[1]
         self.num_replicates = data.f_obs.shape[0]
+        # For a sparse network the weights are an edge list of shape (num_edges,) ordered
+        # by gene, otherwise they are a dense (num_genes, num_tfs) matrix
+        self.edge_genes = self.edge_tfs = None
+        self.weights_shape = (self.num_genes, self.num_tfs)
+        connectivity = getattr(data, 'connectivity', None)
+        if connectivity is not None:
+            edge_genes, edge_tfs = np.nonzero(connectivity)
+            self.edge_offsets = np.searchsorted(edge_genes, np.arange(self.num_genes+1))
+            self.edge_genes = tf.constant(edge_genes, dtype='int32')
+            self.edge_tfs = tf.constant(edge_tfs, dtype='int32')
+            self.weights_shape = (edge_genes.shape[0],)
+        # (gene, TF) pairs through which a TF can affect a gene, in the order of the flattened weights
+        pair_genes, pair_tfs = np.nonzero(np.ones(self.weights_shape)) if connectivity is None else (edge_genes, edge_tfs)
+        self.pair_genes = tf.constant(pair_genes, dtype='int32')
+        self.pair_tfs = tf.constant(pair_tfs, dtype='int32')
+        # The pairs are ordered by gene, those of gene j being pair_offsets[j]:pair_offsets[j+1]
+        self.pair_offsets = np.arange(self.num_genes+1) * self.num_tfs if connectivity is None else self.edge_offsets
+        self.integrate = QUADRATURES[options.quadrature]
+        # Low-rank latents are held at the inducing points and linearly interpolated onto τ
+        self.interpolation = None
+        if options.num_inducing is not None:
+            self.interpolation = tf.constant(
+                interpolation_matrix(data.τ, inducing_points(data.τ, options.num_inducing)))
+        # The regulatory inputs and likelihood terms are computed in compute_dtype, the ODE
+        # solutions (see decay_integral) and all sums in float64
+        self.compute_dtype = tf.as_dtype(options.compute_dtype)
+        self.tiny = 1e-100 if self.compute_dtype == tf.float64 else np.finfo(np.float32).tiny
+        # The quadrature rules are linear, so the integrals up to each observation time are a
+        # product with the rule's weights (N_p, T): row n is the cumulative integral of e_n.
+        τ = tf.constant(data.τ, dtype='float64')
+        self.τ_obs = tf.gather(τ, data.common_indices)
+        self.observation_weights = tf.gather(
+            self.integrate(tf.eye(τ.shape[0], dtype='float64'), τ[1]-τ[0]), data.common_indices, axis=-1)
+        if options.xla:
+            self.calculate_protein = xla_function(self.calculate_protein)
+            self.predict_m = xla_function(self.predict_m)
+            self.genes = xla_function(self.genes)
+            self.tfs = xla_function(self.tfs)
 
     @tf.function
     def calculate_protein(self, fbar, k_fbar, Δ): # Calculate p_i vector
-        τ = self.data.τ
+        '''
+        Computes the protein trajectories by integrating the translation ODE.
+        All arguments may carry the same leading batch dimensions, i.e.
+        fbar (..., R, I, N_p), k_fbar (..., I) and Δ (..., I).
+        '''
         f_i = inverse_positivity(fbar)
-        δ_i = tf.reshape(logit(k_fbar), (-1, 1))
+        δ_i = logit(k_fbar)[..., None, :, None]
         if self.options.delays:
-            # Add delay 
-            Δ = tf.cast(Δ, 'int32')
-
-            for r in range(self.num_replicates):
-                f_ir = rotate(f_i[r], -Δ)
-                mask = ~tf.sequence_mask(Δ, f_i.shape[2])
-                f_ir = tf.where(mask, f_ir, 0)
-                mask = np.zeros((self.num_replicates, 1, 1), dtype='float64')
-                mask[r] = 1
-                f_i = (1-mask) * f_i + mask * f_ir
-
-        # Approximate integral (trapezoid rule)
-        resolution = τ[1]-τ[0]
-        sum_term = tfm.multiply(tfm.exp(δ_i*τ), f_i)
-        cumsum = 0.5*resolution*tfm.cumsum(sum_term[:, :, :-1] + sum_term[:, :, 1:], axis=2)
-        integrals = tf.concat([tf.zeros((self.num_replicates, self.num_tfs, 1), dtype='float64'), cumsum], axis=2) 
-        exp_δt = tfm.exp(-δ_i*τ)
-        p_i = exp_δt * integrals
-        return p_i
+            # Add delay
+            f_i = self.delay_latents(f_i, Δ)
+
+        # Approximate integral (trapezoid or Simpson rule)
+        return self.decay_integral(δ_i, f_i)
+
+    def cast(self, x):
+        '''Casts x to the dtype used for elementwise computation (Options.compute_dtype)'''
+        return tf.cast(x, self.compute_dtype)
+
+    def decay_integral(self, rate, y, observed=False):
+        '''
+        Computes exp(-rate τ) ∫_0^τ exp(rate s) y(s) ds along τ, or at the observation times
+        if observed, for rates broadcasting against y (..., N_p). This is always evaluated in
+        float64: exp(rate τ) overflows float32 once rate·τ > 88.7, which is inside the kinetics priors.
+        '''
+        τ = self.data.τ
+        integrand = tfm.exp(rate*τ) * tf.cast(y, 'float64')
+        if observed:
+            integrals = tf.matmul(integrand, self.observation_weights)
+            τ = self.τ_obs
+        else:
+            integrals = self.integrate(integrand, τ[1]-τ[0])
+        return tfm.exp(-rate*τ) * integrals
+
+    def delay_latents(self, f_i, Δ):
+        '''
+        Shifts each TF's latent forward by its delay (in grid steps), padding with zeros.
+        The shift is a single gather over the time axis, so f_i (..., R, I, N_p) and
+        Δ (..., I) may carry any broadcastable batch dimensions.
+        '''
+        N_p = f_i.shape[-1]
+        Δ = tf.cast(Δ, 'int32')
+        indices = tf.range(N_p) - Δ[..., None, :, None]
+        mask = indices >= 0
+        shape = tf.broadcast_dynamic_shape(tf.shape(f_i), tf.shape(indices))
+        rank = max(f_i.shape.rank, indices.shape.rank)
+        f_i = tf.gather(tf.broadcast_to(f_i, shape),
+                        tf.broadcast_to(tfm.maximum(indices, 0), shape),
+                        batch_dims=rank-1)
+        return tf.where(tf.broadcast_to(mask, shape), f_i, tf.zeros([], f_i.dtype))
 
     @tf.function
-    def predict_m(self, kbar, k_fbar, wbar, fbar, w_0bar, Δ):
+    def predict_m(self, kbar, k_fbar, wbar, fbar, w_0bar, Δ, protein=None, gene_range=None, observed=False):
+        '''
+        Computes the mRNA trajectories of shape (..., R, J, N_p). Every parameter
+        may carry an optional leading batch dimension (e.g. chains × samples):
+        kbar (..., J, K), k_fbar (..., I), wbar (..., J, I), fbar (..., R, I, N_p),
+        w_0bar (..., J) and Δ (..., I). Batch dimensions broadcast against each other.
+        If protein is given, it is used in place of recomputing it from fbar, k_fbar and Δ.
+        If gene_range is a tuple (start, stop), only the trajectories of those genes are computed.
+        If observed is True, m is only computed at the observation times, shape (..., R, J, T),
+        integrating up to each of them rather than writing out the cumulative integral on τ.
+        '''
+        if gene_range is not None:
+            start, stop = gene_range
+            kbar = kbar[..., start:stop, :]
+            w_0bar = w_0bar[..., start:stop]
+            if self.edge_genes is None:
+                wbar = wbar[..., start:stop, :]
+            else:
+                wbar = wbar[..., self.edge_offsets[start]:self.edge_offsets[stop]]
+        w = self.cast(wbar)
+        w_0 = self.cast(w_0bar[..., None, :, None])
+
+        if protein is not None:
+            p_i = protein
+        elif self.options.translation:
+            p_i = self.calculate_protein(fbar, k_fbar, Δ)
+        else:
+            p_i = inverse_positivity(fbar)
+        p_i = self.cast(p_i)
+
+        # Calculate m_pred
+        interactions =  self.interactions(w, tfm.log(p_i+self.tiny), gene_range) + w_0
+        return self.transcribe(kbar, interactions, observed=observed)
+
+    def transcribe(self, kbar, interactions, observed=False):
+        '''
+        Integrates the transcription ODE given the gene kinetics kbar (..., J, K) and the
+        regulatory inputs interactions (..., R, J, N_p). See predict_m.
+        '''
         # Take relevant parameters out of log-space
         if self.options.kinetic_exponential:
-            kin = (tf.reshape(tf.exp(logit(kbar[:, i])), (-1, 1)) for i in range(kbar.shape[1]))
+            kin = (tf.exp(logit(kbar[..., i]))[..., None, :, None] for i in range(kbar.shape[-1]))
         else:
-            kin = (tf.reshape(logit(kbar[:, i]), (-1, 1)) for i in range(kbar.shape[1]))
+            kin = (logit(kbar[..., i])[..., None, :, None] for i in range(kbar.shape[-1]))
         if self.options.initial_conditions:
             a_j, b_j, d_j, s_j = kin
         else:
             b_j, d_j, s_j = kin
-        w = (wbar)
-        w_0 = tf.reshape((w_0bar), (-1, 1))
-        τ = self.data.τ
-        N_p = self.data.τ.shape[0]
+        τ = self.τ_obs if observed else self.data.τ
 
-        p_i = inverse_positivity(fbar)
-        if self.options.translation:
-            p_i = self.calculate_protein(fbar, k_fbar, Δ)
-
-        # Calculate m_pred
-        resolution = τ[1]-τ[0]
-        interactions =  tf.matmul(w, tfm.log(p_i+1e-100)) + w_0
         G = tfm.sigmoid(interactions) # TF Activation Function (sigmoid)
-        sum_term = G * tfm.exp(d_j*τ)
-        integrals = tf.concat([tf.zeros((self.num_replicates, self.num_genes, 1), dtype='float64'), # Trapezoid rule
-                            0.5*resolution*tfm.cumsum(sum_term[:, :, :-1] + sum_term[:, :, 1:], axis=2)], axis=2) 
-        exp_dt = tfm.exp(-d_j*τ)
-        integrals = tfm.multiply(exp_dt, integrals)
+        integrals = self.decay_integral(d_j, G, observed=observed)
 
         m_pred = b_j/d_j + s_j*integrals
         if self.options.initial_conditions:
-            m_pred += tfm.multiply((a_j-b_j/d_j), exp_dt)
+            m_pred += tfm.multiply((a_j-b_j/d_j), tfm.exp(-d_j*τ))
         return m_pred
 
+    def interactions(self, w, log_p, gene_range=None):
+        '''
+        Computes the weighted sum of log protein over each gene's regulators, shape (..., R, J, N_p).
+        w is (..., J, I), or (..., num_edges) for a sparse network, in which case the sum is
+        a gather of the regulating TFs followed by a segment sum over each gene's edges.
+        log_p is (..., R, I, N_p). If gene_range is given, w holds only the weights of those genes.
+        '''
+        if self.edge_genes is None:
+            return tf.matmul(w[..., None, :, :], log_p)
+        start, stop = (0, self.num_genes) if gene_range is None else gene_range
+        edges = slice(self.edge_offsets[start], self.edge_offsets[stop])
+        weighted = tf.gather(log_p, self.edge_tfs[edges], axis=-2) * w[..., None, :, None] # (..., R, E, N_p)
+        rank = weighted.shape.rank
+        # Segment sums reduce over the leading axis, so move the edge axis there and back
+        weighted = tf.transpose(weighted, [rank-2] + list(range(rank-2)) + [rank-1])
+        summed = tfm.unsorted_segment_sum(weighted, self.edge_genes[edges] - start, stop - start)
+        return tf.transpose(summed, list(range(1, rank-1)) + [0, rank-1])
+
     def get_parameters_from_state(self, all_states, state_indices,
                                   fbar=None, kbar=None, k_fbar=None,
                                   wbar=None, w_0bar=None, σ2_m=None, Δ=None):
@@ -95,7 +205,7 @@ class TranscriptionLikelihood():
             wbar = all_states[state_indices['kinetics']][nuts_index] if wbar is None else wbar
             w_0bar = all_states[state_indices['kinetics']][nuts_index+1] if w_0bar is None else w_0bar
         else:
-            wbar = logistic(1*tf.ones((self.num_genes, self.num_tfs), dtype='float64'))
+            wbar = logistic(1*tf.ones(self.weights_shape, dtype='float64'))
             w_0bar = 0.5*tf.ones(self.num_genes, dtype='float64')
 
         σ2_m = all_states[state_indices['σ2_m']] if σ2_m is None else σ2_m
@@ -104,23 +214,144 @@ class TranscriptionLikelihood():
             fbar = all_states[state_indices['latents']]
             if self.options.joint_latent:
                 fbar = fbar[0]
+            elif self.options.whitened_latents:
+                fbar = self.colour_latents(fbar, all_states[state_indices['kernel_params']], cached=True)
         if self.options.delays:
             Δ = all_states[state_indices['Δ']] if Δ is None else Δ
         else:
             Δ = tf.zeros((self.num_tfs,), dtype='float64')
-        return fbar, kbar, k_fbar, wbar, w_0bar, σ2_m, Δ
+        return self.latents_on_grid(fbar), kbar, k_fbar, wbar, w_0bar, σ2_m, Δ
 
-    @tf.function
-    def _genes(self, fbar, kbar, k_fbar, wbar, w_0bar, σ2_m, Δ):
-        m_pred = self.predict_m(kbar, k_fbar, wbar, fbar, w_0bar, Δ)
-        sq_diff = tfm.square(self.data.m_obs - tf.transpose(tf.gather(tf.transpose(m_pred),self.data.common_indices)))
+    def colour_latents(self, ε, kernel_params, cached=False):
+        '''
+        Maps whitened latents ε (..., R, I, M) to fbar = L(θ)ε, where L(θ) is the Cholesky
+        factor of the latent prior covariance for the hyperparameters kernel_params, each (..., I).
+        If cached is True, L(θ) is taken from the kernel selector's Cholesky cache, which requires
+        unbatched hyperparameters that are not being differentiated.
+        '''
+        L = self.kernel_selector.cholesky(*kernel_params, cached=cached)
+        L = tf.reshape(L, (*kernel_params[0].shape, *L.shape[-2:])) # (..., I, M, M)
+        return tf.linalg.matvec(L[..., None, :, :, :], ε)
+
+    def latents_on_grid(self, fbar):
+        '''
+        Interpolates latents held at the inducing points, (..., R, I, M), onto τ.
+        Latents which are already on τ (Options.num_inducing is None) are returned as they are.
+        '''
+        if self.interpolation is None:
+            return fbar
+        return tf.matmul(fbar, self.interpolation, transpose_b=True)
 
-        variance = tf.reshape(σ2_m, (-1, 1))
+    def protein_from_state(self, all_states, state_indices):
+        '''
+        Computes the protein trajectories for the latents, k_fbar and Δ in all_states.
+        Log-probs of blocks which leave these unchanged (e.g. kinetics, σ2_m, weights)
+        can compute this once per step and pass it to genes(protein=...) rather than
+        re-integrating the translation ODE on every evaluation.
+        '''
+        fbar, _, k_fbar, _, _, _, Δ = self.get_parameters_from_state(all_states, state_indices)
+        if not self.options.translation:
+            return inverse_positivity(fbar)
+        return self.calculate_protein(fbar, k_fbar, Δ)
+
+    def gene_variance(self, σ2_m):
+        '''Returns the observation variance of the genes, broadcastable to (..., R, J, T)'''
         if self.preprocessing_variance:
-            variance = logit(variance) + self.data.σ2_m_pre # add PUMA variance
-        log_lik = -0.5*tfm.log(2*PI*variance) - 0.5*sq_diff/variance
-        log_lik = tf.reduce_sum(log_lik)
-        return log_lik
+            variance = logit(σ2_m)[..., None, :, None] + self.data.σ2_m_pre # add PUMA variance
+        else:
+            variance = self.noise_variance(σ2_m)
+        return self.cast(variance)
+
+    def gene_log_lik(self, m_pred, m_obs, variance):
+        '''Returns the log-likelihood of each replicate and gene (..., R, J) given m_pred at the observations'''
+        sq_diff = tfm.square(self.cast(m_obs) - self.cast(m_pred))
+        log_lik = -0.5*tfm.log(2*self.cast(PI)*variance) - 0.5*sq_diff/variance
+        return tf.reduce_sum(tf.cast(log_lik, 'float64'), axis=-1)
+
+    @tf.function
+    def _genes(self, fbar, kbar, k_fbar, wbar, w_0bar, σ2_m, Δ, per_gene=False, per_replicate=False, protein=None):
+        variance = self.gene_variance(σ2_m)
+        # The protein is shared by every block of genes, so it is only integrated once
+        if protein is None:
+            protein = self.calculate_protein(fbar, k_fbar, Δ) if self.options.translation else inverse_positivity(fbar)
+
+        chunk_size = self.options.gene_chunk_size or self.num_genes
+        log_lik = list()
+        for start in range(0, self.num_genes, chunk_size):
+            stop = min(start + chunk_size, self.num_genes)
+            gene_range = None if chunk_size == self.num_genes else (start, stop)
+            # Each block waits for the previous so that only one block's temporaries are live
+            with tf.control_dependencies(log_lik[-1:]):
+                m_pred = self.predict_m(kbar, k_fbar, wbar, fbar, w_0bar, Δ,
+                                        protein=protein, gene_range=gene_range, observed=True)
+            log_lik.append(self.gene_log_lik(m_pred, self.data.m_obs[:, start:stop], variance[..., start:stop, :]))
+        log_lik = tf.concat(log_lik, axis=-1) # (..., R, J)
+        if per_gene:
+            return tf.reduce_sum(log_lik, axis=-2)
+        if per_replicate:
+            return tf.reduce_sum(log_lik, axis=-1)
+        return tf.reduce_sum(log_lik, axis=[-2, -1])
+
+    @tf.function
+    def tf_local_genes(self, all_states, state_indices, fstar):
+        '''
+        Computes the gene log-likelihood with the latents of TF i replaced by fstar[:, i], for
+        each TF i at once, shape (I,). The current log-likelihood is also returned.
+        Only the (gene, TF) pairs through which TF i acts are recomputed for TF i: the change
+        to the gene's interactions is added to the current ones, and the change in that
+        gene's log-likelihood to the current total. The cost is therefore linear in the
+        number of pairs (num_genes × num_tfs, or the edges of a sparse network) rather than
+        quadratic in the number of TFs. As in _genes, the genes (and their pairs) are processed
+        Options.gene_chunk_size at a time to bound the memory of the temporaries.
+        '''
+        fbar, kbar, k_fbar, wbar, w_0bar, σ2_m, Δ = self.get_parameters_from_state(all_states, state_indices)
+        fstar = self.latents_on_grid(fstar)
+        if self.options.translation:
+            p_i, pstar_i = self.calculate_protein(fbar, k_fbar, Δ), self.calculate_protein(fstar, k_fbar, Δ)
+        else:
+            p_i, pstar_i = inverse_positivity(fbar), inverse_positivity(fstar)
+        log_p = tfm.log(self.cast(p_i)+self.tiny)
+        log_pstar = tfm.log(self.cast(pstar_i)+self.tiny)
+        variance = self.gene_variance(σ2_m)
+        w = self.cast(wbar)
+        w_pairs = tf.reshape(w, (-1,))
+
+        chunk_size = self.options.gene_chunk_size or self.num_genes
+        log_lik, tf_change = list(), list()
+        for start in range(0, self.num_genes, chunk_size):
+            stop = min(start + chunk_size, self.num_genes)
+            gene_range = None if chunk_size == self.num_genes else (start, stop)
+            pairs = slice(self.pair_offsets[start], self.pair_offsets[stop])
+            pair_genes, pair_tfs = self.pair_genes[pairs], self.pair_tfs[pairs]
+            # Each block waits for the previous so that only one block's temporaries are live
+            with tf.control_dependencies(tf_change[-1:]):
+                w_block = w[start:stop] if self.edge_genes is None else w_pairs[pairs]
+                interactions = self.interactions(w_block, log_p, gene_range) + self.cast(w_0bar[None, start:stop, None])
+            m_pred = self.transcribe(kbar[start:stop], interactions, observed=True)
+            block_log_lik = self.gene_log_lik(m_pred, self.data.m_obs[:, start:stop],
+                                              variance[..., start:stop, :]) # (R, stop-start)
+
+            # Interactions of each pair's gene with only the pair's TF changed, (R, P, N_p)
+            pair_interactions = tf.gather(interactions, pair_genes - start, axis=-2) + \
+                w_pairs[pairs][:, None] * tf.gather(log_pstar - log_p, pair_tfs, axis=-2)
+            pair_m_pred = self.transcribe(tf.gather(kbar, pair_genes), pair_interactions, observed=True)
+            pair_log_lik = self.gene_log_lik(pair_m_pred,
+                                             tf.gather(self.data.m_obs, pair_genes, axis=-2),
+                                             tf.gather(variance, pair_genes, axis=-2))
+            pair_change = tf.reduce_sum(pair_log_lik - tf.gather(block_log_lik, pair_genes - start, axis=-1), axis=0)
+            log_lik.append(tf.reduce_sum(block_log_lik))
+            tf_change.append(tfm.unsorted_segment_sum(pair_change, pair_tfs, self.num_tfs))
+        log_lik = tf.add_n(log_lik)
+        return log_lik + tf.add_n(tf_change), log_lik
+
+    def noise_variance(self, σ2):
+        '''
+        Reshapes a white noise variance of shape (num,) or (..., num, 1)
+        to broadcast against (..., R, num, T) observations.
+        '''
+        if σ2.shape.rank == 1:
+            σ2 = tf.reshape(σ2, (-1, 1))
+        return σ2[..., None, :, :]
 
     @tf.function#(experimental_compile=True)
     def genes(self, all_states=None, state_indices=None,
@@ -130,29 +361,49 @@ class TranscriptionLikelihood():
               wbar=None,
               w_0bar=None,
               σ2_m=None, 
-              Δ=None):
+              Δ=None,
+              per_gene=False,
+              per_replicate=False,
+              protein=None):
         '''
         Computes likelihood of the genes.
         If any of the optional args are None, they are replaced by their 
-        current value in all_states.
+        current value in all_states. An fbar override is never whitened (see colour_latents).
+        Args may carry a leading batch dimension, in which case the result has that batch shape
+        rather than being a scalar.
+        If per_gene is True, the log-likelihood of each gene is returned, shape (..., J).
+        Since genes are conditionally independent given the latents, these sum to the total.
+        Similarly, if per_replicate is True the log-likelihood of each replicate is returned, shape (..., R).
+        protein is a cache of the protein trajectories of all_states (see protein_from_state).
+        It is only used if none of the blocks it depends on (fbar, k_fbar, Δ) are overridden.
         '''
+        if fbar is not None or k_fbar is not None or Δ is not None:
+            protein = None # invalidated by a change to the latents, k_fbar or Δ
         params = self.get_parameters_from_state(
             all_states, state_indices, fbar, kbar, k_fbar, wbar, w_0bar, σ2_m, Δ)
-        return self._genes(*params)
+        return self._genes(*params, per_gene=per_gene, per_replicate=per_replicate, protein=protein)
 
     @tf.function#(experimental_compile=True)
-    def tfs(self, σ2_f, fbar): 
+    def tfs(self, σ2_f, fbar, per_replicate=False, per_tf=False): 
         '''
         Computes log-likelihood of the transcription factors.
+        fbar (..., R, I, N_p) and σ2_f (..., I, 1) may carry a leading batch dimension.
+        If per_replicate is True, the log-likelihood of each replicate is returned, shape (..., R),
+        and if per_tf is True that of each TF, shape (..., I).
         '''
         # assert self.options.tf_mrna_present
         if not self.preprocessing_variance:
-            variance = tf.reshape(σ2_f, (-1, 1))
+            variance = self.noise_variance(σ2_f)
         else:
             variance = self.data.σ2_f_pre
-        f_pred = inverse_positivity(fbar)
-        sq_diff = tfm.square(self.data.f_obs - tf.transpose(tf.gather(tf.transpose(f_pred),self.data.common_indices)))
+        fbar = self.latents_on_grid(fbar)
+        f_pred = inverse_positivity(tf.gather(fbar, self.data.common_indices, axis=-1))
+        sq_diff = tfm.square(self.data.f_obs - f_pred)
         log_lik = -0.5*tfm.log(2*PI*variance) - 0.5*sq_diff/variance
-        log_lik = tf.reduce_sum(log_lik)
+        if per_replicate:
+            return tf.reduce_sum(log_lik, axis=[-2, -1])
+        if per_tf:
+            return tf.reduce_sum(log_lik, axis=[-3, -1])
+        log_lik = tf.reduce_sum(log_lik, axis=[-3, -2, -1])
 
         return log_lik
@@ -12,8 +12,11 @@ from reggae.mcmc.parameter import KernelParameter, Parameter, Params
 from reggae.mcmc.results import GenericResults, SampleResults
 from reggae.mcmc import Options
 from reggae.gp import GPKernelSelector
-from reggae.mcmc.kernels import LatentKernel, MixedKernel, DelayKernel, GibbsKernel
+from reggae.gp.toeplitz import toeplitz_mvn_log_prob
+from reggae.gp.state_space import state_space_log_prob
+from reggae.mcmc.kernels import LatentKernel, EllipticalSliceKernel, MixedKernel, DelayKernel, GibbsKernel
 from reggae.mcmc.kernels.wrappers import RWMWrapperKernel
+from reggae.mcmc.kernels.mh import KineticsKernel
 from reggae.data_loaders import DataHolder
 from reggae.utilities import jitter_cholesky, logit, logistic, LogisticNormal, inverse_positivity, save_object
 from reggae.mcmc import TranscriptionLikelihood
@@ -38,9 +41,15 @@ class TranscriptionMixedSampler():
         self.num_genes = data.m_obs.shape[1]
         self.num_replicates = data.m_obs.shape[0]
 
-        self.likelihood = TranscriptionLikelihood(data, options)
+        if options.whitened_latents and options.joint_latent:
+            raise Exception('Whitened latents require the kernel parameters in their own block (joint_latent=False)')
+        if options.latent_sampler == 'ess' and options.joint_latent:
+            raise Exception('Elliptical slice sampling requires the kernel parameters in their own block (joint_latent=False)')
+        if options.latent_sampler == 'nuts' and not options.whitened_latents:
+            raise Exception('NUTS samples the whitened latents (whitened_latents=True)')
         self.options = options
         self.kernel_selector = GPKernelSelector(data, options)
+        self.likelihood = TranscriptionLikelihood(data, options, self.kernel_selector)
 
         self.state_indices = {}
         step_sizes = self.options.initial_step_sizes
@@ -51,22 +60,39 @@ class TranscriptionMixedSampler():
         kernel_initial = self.kernel_selector.initial_params()
 
         f_step_size = step_sizes['latents'] if 'latents' in step_sizes else 20
-        latents_kernel = LatentKernel(data, options, self.likelihood, 
-                                      self.kernel_selector,
-                                      self.state_indices,
-                                      f_step_size*tf.ones(self.N_p, dtype='float64'))
-        latents_initial = 0.3*tf.ones((self.num_replicates, self.num_tfs, self.N_p), dtype='float64')
+        num_latent = self.kernel_selector.N_p # N_p, or the number of inducing points
+        if options.latent_sampler == 'ess':
+            latents_kernel = EllipticalSliceKernel(data, options, self.likelihood,
+                                                   self.kernel_selector, self.state_indices)
+        else: # with NUTS this only provides latent_log_lik
+            latents_kernel = LatentKernel(data, options, self.likelihood, 
+                                          self.kernel_selector,
+                                          self.state_indices,
+                                          f_step_size*tf.ones(num_latent, dtype='float64'))
+        latents_initial = 0.3*tf.ones((self.num_replicates, self.num_tfs, num_latent), dtype='float64')
         if self.options.joint_latent:
             latents_initial = [latents_initial, *kernel_initial]
-        latents = KernelParameter('latents', self.fbar_prior, latents_initial,
-                                kernel=latents_kernel, requires_all_states=False)
+        if options.latent_sampler == 'nuts':
+            # Whitened latents have a N(0, I) prior, so the posterior geometry is set by the
+            # likelihood alone and a single step size suits every replicate, TF and time point.
+            def latents_log_prob(all_states):
+                def latents_log_prob_fn(ε):
+                    new_prob = tf.reduce_sum(tfd.Normal(f64(0), f64(1)).log_prob(ε))
+                    return new_prob + tf.reduce_sum(latents_kernel.latent_log_lik(ε, all_states))
+                return latents_log_prob_fn
+            latents = KernelParameter('latents', tfd.Normal(f64(0), f64(1)), latents_initial,
+                                      hmc_log_prob=latents_log_prob, requires_all_states=True,
+                                      step_size=step_sizes['latents'] if 'latents' in step_sizes else 0.05)
+        else:
+            latents = KernelParameter('latents', self.fbar_prior, latents_initial,
+                                    kernel=latents_kernel, requires_all_states=False)
 
         # White noise for genes
         if not options.preprocessing_variance:
             def m_sq_diff_fn(all_states):
-                fbar, k_fbar, kbar, wbar, w_0bar, σ2_m, Δ = self.likelihood.get_parameters_from_state(all_states, self.state_indices)
-                m_pred = self.likelihood.predict_m(kbar, k_fbar, wbar, fbar, w_0bar, Δ)
-                sq_diff = tfm.square(self.data.m_obs - tf.transpose(tf.gather(tf.transpose(m_pred),self.data.common_indices)))
+                fbar, kbar, k_fbar, wbar, w_0bar, σ2_m, Δ = self.likelihood.get_parameters_from_state(all_states, self.state_indices)
+                m_pred = self.likelihood.predict_m(kbar, k_fbar, wbar, fbar, w_0bar, Δ, observed=True)
+                sq_diff = tfm.square(self.data.m_obs - m_pred)
                 return tf.reduce_sum(sq_diff, axis=0)
 
             σ2_m_kernel = GibbsKernel(data, options, self.likelihood, tfd.InverseGamma(f64(0.01), f64(0.01)), 
@@ -74,12 +100,14 @@ class TranscriptionMixedSampler():
             σ2_m = KernelParameter('σ2_m', None, 1e-3*tf.ones((self.num_genes, 1), dtype='float64'), kernel=σ2_m_kernel)
         else:
             def σ2_m_log_prob(all_states):
+                protein = self.likelihood.protein_from_state(all_states, self.state_indices)
                 def σ2_m_log_prob_fn(σ2_mstar):
                     # tf.print('starr:', logit(σ2_mstar))
                     new_prob = self.likelihood.genes(
                         all_states=all_states, 
                         state_indices=self.state_indices,
-                        σ2_m=σ2_mstar 
+                        σ2_m=σ2_mstar,
+                        protein=protein
                     ) + self.params.σ2_m.prior.log_prob(logit(σ2_mstar))
                     # tf.print('prob', tf.reduce_sum(new_prob))
                     return tf.reduce_sum(new_prob)                
@@ -94,8 +122,14 @@ class TranscriptionMixedSampler():
                 def kernel_params_log_prob(param_0bar, param_1bar):
                     param_0 = logit(param_0bar, nan_replace=self.params.kernel_params.prior[0].b)
                     param_1 = logit(param_1bar, nan_replace=self.params.kernel_params.prior[1].b)
-                    new_prob = tf.reduce_sum(self.params.latents.prior(
-                                all_states[self.state_indices['latents']], param_0bar, param_1bar))
+                    if self.options.whitened_latents:
+                        # The whitened latents are independent of θ a priori, so only the likelihood changes
+                        new_prob = tf.reduce_sum(latents_kernel.latent_log_lik(
+                                all_states[self.state_indices['latents']], all_states,
+                                kernel_params=[param_0bar, param_1bar]))
+                    else:
+                        new_prob = tf.reduce_sum(self.params.latents.prior(
+                                    all_states[self.state_indices['latents']], param_0bar, param_1bar))
                     new_prob += self.params.kernel_params.prior[0].log_prob(param_0)
                     new_prob += self.params.kernel_params.prior[1].log_prob(param_1)
                     return tf.reduce_sum(new_prob)
@@ -111,10 +145,11 @@ class TranscriptionMixedSampler():
         
         # Kinetic parameters & Interaction weights
         w_prior = LogisticNormal(f64(-2), f64(2))
-        w_initial = logistic(1*tf.ones((self.num_genes, self.num_tfs), dtype='float64'))
+        w_initial = logistic(1*tf.ones(self.likelihood.weights_shape, dtype='float64'))
         w_0_prior = LogisticNormal(f64(-0.8), f64(0.8))
         w_0_initial = logistic(0*tf.ones(self.num_genes, dtype='float64'))
         def weights_log_prob(all_states):
+            protein = self.likelihood.protein_from_state(all_states, self.state_indices)
             def weights_log_prob_fn(wbar, w_0bar):
                 # tf.print((wbar))
                 new_prob = tf.reduce_sum(self.params.weights.prior[0].log_prob((wbar))) 
@@ -124,7 +159,8 @@ class TranscriptionMixedSampler():
                     all_states=all_states,
                     state_indices=self.state_indices,
                     wbar=wbar,
-                    w_0bar=w_0bar
+                    w_0bar=w_0bar,
+                    protein=protein
                 ))
                 # tf.print(new_prob)
                 return new_prob
@@ -140,6 +176,9 @@ class TranscriptionMixedSampler():
         kbar_initial = 0.8*tf.ones((self.num_genes, num_kin), dtype='float64')
 
         def kbar_log_prob(all_states):
+            protein = None
+            if not options.translation: # otherwise k_fbar is in this block so the protein changes
+                protein = self.likelihood.protein_from_state(all_states, self.state_indices)
             def kbar_log_prob_fn(*args): #kbar, k_fbar, wbar, w_0bar
                 index = 0
                 kbar = args[index]
@@ -168,6 +207,7 @@ class TranscriptionMixedSampler():
                 new_prob += tf.reduce_sum(self.likelihood.genes(
                     all_states=all_states,
                     state_indices=self.state_indices,
+                    protein=protein,
                     **lik_args
                 ))
                 return tf.reduce_sum(new_prob)
@@ -183,11 +223,28 @@ class TranscriptionMixedSampler():
             kinetics_priors += [LogisticNormal(0.1, 7)]
         if options.weights:
             kinetics_initial += [w_initial, w_0_initial]
+
+        kinetics_kernel = None
+        if options.kinetics_sampler == 'metropolis':
+            def kbar_log_prior(kbar):
+                k_m = logit(kbar)
+                if self.options.kinetic_exponential:
+                    k_m = tf.exp(k_m)
+                return kinetics_priors[0].log_prob(k_m)
+            kinetics_log_priors = [kbar_log_prior]
+            if options.translation:
+                kinetics_log_priors += [lambda k_fbar: kinetics_priors[1].log_prob(logit(k_fbar))]
+            if options.weights:
+                kinetics_log_priors += [w_prior.log_prob, w_0_prior.log_prob]
+            kinetics_step_size = step_sizes['kinetics'] if 'kinetics' in step_sizes else 0.01
+            kinetics_kernel = KineticsKernel(self.likelihood, options, kinetics_log_priors, self.state_indices,
+                                             kinetics_step_size*tf.ones(1, dtype='float64'))
         kinetics = KernelParameter(
             'kinetics', 
             kinetics_priors, 
             kinetics_initial,
-            hmc_log_prob=kbar_log_prob, step_size=logistic_step_size, requires_all_states=True)
+            hmc_log_prob=kbar_log_prob, step_size=logistic_step_size, 
+            requires_all_states=kinetics_kernel is None, kernel=kinetics_kernel)
 
 
         delta_kernel = DelayKernel(self.likelihood, 0, 10, self.state_indices, tfd.Exponential(f64(0.3)))
@@ -197,7 +254,8 @@ class TranscriptionMixedSampler():
         σ2_f = None
         if not options.preprocessing_variance:
             def f_sq_diff_fn(all_states):
-                f_pred = inverse_positivity(all_states[self.state_indices['latents']][0])
+                fbar = self.likelihood.get_parameters_from_state(all_states, self.state_indices)[0]
+                f_pred = inverse_positivity(fbar)
                 sq_diff = tfm.square(self.data.f_obs - tf.transpose(tf.gather(tf.transpose(f_pred),self.data.common_indices)))
                 return tf.reduce_sum(sq_diff, axis=0)
             kernel = GibbsKernel(data, options, self.likelihood, tfd.InverseGamma(f64(0.01), f64(0.01)), 
@@ -225,8 +283,15 @@ class TranscriptionMixedSampler():
         })
 
     def fbar_prior(self, fbar, param_0bar, param_1bar):
+        if self.kernel_selector.toeplitz:
+            c = self.kernel_selector.rbf_row(param_0bar, param_1bar)
+            jitter = 1e-8*tf.one_hot(0, c.shape[-1], dtype='float64')
+            return tf.reduce_sum(toeplitz_mvn_log_prob(c + jitter, fbar))
+        if self.kernel_selector.state_space:
+            F, P = self.kernel_selector.sde(param_0bar, param_1bar)
+            return tf.reduce_sum(state_space_log_prob(F, P, self.kernel_selector.τ, fbar))
         m, K = self.kernel_selector()(param_0bar, param_1bar)
-        jitter = tf.linalg.diag(1e-8 *tf.ones(self.N_p, dtype='float64'))
+        jitter = tf.linalg.diag(1e-8 *tf.ones(K.shape[-1], dtype='float64'))
         prob = 0
         for r in range(self.num_replicates):
             for i in range(self.num_tfs):
@@ -242,7 +307,9 @@ class TranscriptionMixedSampler():
         send_all_states = [param.requires_all_states for param in self.active_params]
 
         current_state = [param.value for param in self.active_params]
-        mixed_kern = MixedKernel(kernels, send_all_states, T, skip=skip)
+        mixed_kern = MixedKernel(kernels, send_all_states, T, skip=skip, xla=self.options.xla)
+        if self.options.xla:
+            mixed_kern.check_xla(current_state)
         
         def trace_fn(a, previous_kernel_results):
             return previous_kernel_results.is_accepted
@@ -290,18 +357,15 @@ class TranscriptionMixedSampler():
         return samples, is_accepted
     
     def sample_proteins(self, results, num_results):
-        p_samples = list()
-        for i in range(1, num_results+1):
-            delta = results.Δ[i] if results.Δ is not None else None
-            p_samples.append(self.likelihood.calculate_protein(results.fbar[-i], 
-                             results.k_fbar[-i], delta))
-        return np.array(p_samples)
+        indices = np.arange(1, num_results+1)
+        delta = self.take_samples(results.Δ, indices) if self.options.delays else None
+        p_samples = self.likelihood.calculate_protein(self.take_samples(results.fbar, indices),
+                                                      self.take_samples(results.k_fbar, indices)[..., 0], delta)
+        return p_samples.numpy()
 
     def sample_latents(self, results, num_results, step=1):
-        m_preds = list()
-        for i in range(1, num_results, step):
-            m_preds.append(self.predict_m_with_results(results, i))
-        return np.array(m_preds)
+        m_preds = self.predict_m_with_results(results, np.arange(1, num_results, step))
+        return m_preds.numpy()
 
     def results(self, burnin=0):
         Δ = σ2_f = k_fbar = None
@@ -320,11 +384,15 @@ class TranscriptionMixedSampler():
             if k_fbar.ndim < 3:
                 k_fbar = np.expand_dims(k_fbar, 2)
         if not self.options.joint_latent:
-            kernel_params = self.samples[self.state_indices['kernel_params']][burnin:]
+            kernel_params = [param[burnin:] for param in self.samples[self.state_indices['kernel_params']]]
+            fbar = fbar[burnin:]
+            if self.options.whitened_latents:
+                fbar = self.likelihood.colour_latents(fbar, kernel_params)
         else:
             kernel_params = [fbar[1][burnin:], fbar[2][burnin:]]
             fbar = fbar[0][burnin:]
-        wbar = tf.stack([logistic(1*tf.ones((self.num_genes, self.num_tfs), dtype='float64')) for _ in range(fbar.shape[0])], axis=0)
+        fbar = self.likelihood.latents_on_grid(fbar)
+        wbar = tf.stack([logistic(1*tf.ones(self.likelihood.weights_shape, dtype='float64')) for _ in range(fbar.shape[0])], axis=0)
         w_0bar = tf.stack([0.5*tf.ones(self.num_genes, dtype='float64') for _ in range(fbar.shape[0])], axis=0)
         if self.options.weights:
             nuts_index += 1
@@ -367,11 +435,19 @@ class TranscriptionMixedSampler():
         model.samples = state.samples
         return model
 
+    @staticmethod
+    def take_samples(samples, i):
+        '''Takes the i-th last sample(s), where i may be an int or an array of ints'''
+        return tf.gather(samples, samples.shape[0] - np.asarray(i))
+
     def predict_m_with_results(self, results, i=1):
-        delay = results.Δ[-i] if self.options.delays else None
-        k_fbar = results.k_fbar[-i] if self.options.translation else None
-        return self.likelihood.predict_m(results.kbar[-i], k_fbar, results.wbar[-i], 
-                                         results.fbar[-i], results.w_0bar[-i], delay)
+        '''If i is an array, the predictions are computed in one batched likelihood call'''
+        delay = self.take_samples(results.Δ, i) if self.options.delays else None
+        k_fbar = self.take_samples(results.k_fbar, i)[..., 0] if self.options.translation else None
+        return self.likelihood.predict_m(self.take_samples(results.kbar, i), k_fbar,
+                                         self.take_samples(results.wbar, i),
+                                         self.take_samples(results.fbar, i),
+                                         self.take_samples(results.w_0bar, i), delay)
 
     def predict_m_with_current(self):
         return self.likelihood.predict_m(self.params.kinetics.value[0], 
@@ -5,7 +5,9 @@ class Options:
     preprocessing_variance: bool = True  # True if data processing variances present (e.g. mmgmos)
     tf_mrna_present:        bool = True  # False for inferred protein
     delays:                 bool = False # True if delay params used
-    kernel:                 str = 'rbf'  # Kernel for latent function, rbf/mlp
+    kernel:                 str = 'rbf'  # Kernel for latent function, rbf/mlp/matern12/matern32/matern52
+    kinetics_sampler:       str = 'nuts' # Sampler for the kinetics block, nuts/metropolis (gene-wise acceptance)
+    latent_sampler:         str = 'metropolis' # Sampler for the latents if joint_latent=False, metropolis/ess (elliptical slice)/nuts (whitened_latents only)
     joint_latent:           bool = True  # Whether to sample the latents jointly with hyperparams
     initial_step_sizes:     dict = field(default_factory=dict)
     weights:                bool = True  # True if weights used
@@ -13,4 +15,11 @@ class Options:
     translation:            bool = True  # True if the translation mechanism is active
     kinetic_exponential:    bool = False # True if kinetic params are exponentiated
     kernel_exponential:     bool = False # True if kernel params are exponentiated
+    quadrature:             str = 'trapezoid' # Rule for the ODE integrals, trapezoid/simpson
+    xla:                    bool = False # True to XLA-compile the likelihood and kernel steps
+    compute_dtype:          str = 'float64' # dtype of the regulatory inputs and likelihood terms, float64/float32
+    gene_chunk_size:        int = None   # Number of genes per block of the likelihood, None for all at once
+    num_inducing:           int = None   # Number of inducing points of the latent GPs, None for the full grid
+    toeplitz:               bool = False # True to use Toeplitz/FFT algebra for the rbf latent prior on a uniform grid
+    whitened_latents:       bool = False # True to sample whitened latents ε, fbar = L(θ)ε (requires joint_latent=False)
     
\ No newline at end of file
@@ -25,10 +25,74 @@ def discretise(t, num_disc = 10):
     common_indices = np.searchsorted(τ, t)
     return τ, common_indices
 
-def get_time_square(times, N):
-    t_1 = tf.transpose(tf.reshape(tf.tile(times, [N]), [N, N]))
-    t_2 = tf.reshape(tf.tile(times, [N]), [N, N])
-    return t_1, t_2
+def cumulative_trapezoid(y, dx):
+    '''Cumulative integral of y along its last axis (uniform spacing dx) by the trapezoid rule'''
+    # Equal to the cumulative sum of 0.5*dx*(y[k]+y[k+1]) with a leading zero, written
+    # without a concat so that its gradient compiles with XLA inside while loops.
+    return dx*(tfm.cumsum(y, axis=-1) - 0.5*(y[..., :1] + y))
+
+def cumulative_simpson(y, dx):
+    '''
+    Cumulative integral of y along its last axis (uniform spacing dx, at least 3 points).
+    Each interval is integrated exactly for the quadratic through it and its right
+    neighbour (left neighbour for the final interval), giving third-order accuracy
+    compared to the second-order trapezoid rule.
+    '''
+    forward = 5*y[..., :-2] + 8*y[..., 1:-1] - y[..., 2:]
+    last = -y[..., -3:-2] + 8*y[..., -2:-1] + 5*y[..., -1:]
+    intervals = dx/12*tf.concat([forward, last], axis=-1)
+    return tf.concat([tf.zeros_like(y[..., :1]), tfm.cumsum(intervals, axis=-1)], axis=-1)
+
+QUADRATURES = {
+    'trapezoid': cumulative_trapezoid,
+    'simpson': cumulative_simpson,
+}
+
+def select_num_disc(t, integrand, tol=1e-3, quadrature='simpson', max_num_disc=20):
+    '''
+    Chooses the smallest number of discretisation points between observations which
+    integrates `integrand` to a relative accuracy of `tol` at the observation times.
+    Args:
+        t: observation times, as given to `discretise`.
+        integrand: function mapping discretised times τ to integrand values (..., N_p),
+                   e.g. lambda τ: np.exp(d*τ)*f(τ) for representative kinetics and latents.
+        quadrature: rule used for the ODE integrals, trapezoid/simpson.
+    Returns the chosen num_disc, or max_num_disc if tol is not reached.
+    '''
+    integrate = QUADRATURES[quadrature]
+    def integrals(num_disc, rule):
+        τ, common_indices = discretise(t, num_disc=num_disc)
+        return rule(integrand(τ), τ[1]-τ[0]).numpy()[..., common_indices]
+
+    reference = integrals(4*max_num_disc+3, cumulative_simpson)
+    scale = np.maximum(np.abs(reference), 1e-12)
+    for num_disc in range(1, max_num_disc+1):
+        error = np.max(np.abs(integrals(num_disc, integrate) - reference) / scale)
+        if error < tol:
+            return num_disc
+    return max_num_disc
+
+def xla_function(fn):
+    '''Wraps fn (optionally already a tf.function) in a tf.function compiled with XLA'''
+    return tf.function(getattr(fn, 'python_function', fn), experimental_compile=True)
+
+def inducing_points(τ, num_inducing):
+    '''Returns num_inducing points evenly spaced over the range of τ'''
+    return np.linspace(τ[0], τ[-1], num_inducing)
+
+def interpolation_matrix(x, z):
+    '''
+    Returns the (len(x), len(z)) matrix W of linear interpolation weights from the sorted
+    points z onto x, such that W @ f(z) ≈ f(x). Each row has at most two nonzero entries.
+    '''
+    x, z = np.asarray(x, dtype='float64'), np.asarray(z, dtype='float64')
+    index = np.clip(np.searchsorted(z, x, side='right') - 1, 0, z.shape[0] - 2)
+    frac = (x - z[index]) / (z[index+1] - z[index])
+    W = np.zeros((x.shape[0], z.shape[0]))
+    rows = np.arange(x.shape[0])
+    W[rows, index] = 1 - frac
+    W[rows, index+1] = frac
+    return W
 
 def add_diag(A, B):
     C= A + tf.linalg.diag(tf.linalg.diag_part(B))
@@ -119,6 +183,51 @@ class LogisticNormal():
 
         return log_prob
 
+class LRUCache:
+    '''
+    Bounded cache of tensors computed from a key tensor. Entries are held in tf.Variables,
+    so the cache persists across calls of a tf.function (e.g. iterations of a chain) and
+    evicts the least recently used of its `size` slots once they are full.
+    Args:
+        key_shape: shape of the keys, which are matched exactly.
+        value_shapes: list of shapes of the tensors returned by the compute function.
+    '''
+    def __init__(self, key_shape, value_shapes, size=4, dtype='float64'):
+        self.size = size
+        # NaN keys never match, so the cache starts empty
+        self.keys = tf.Variable(np.full((size, *key_shape), np.nan), dtype=dtype)
+        self.values = [tf.Variable(tf.zeros((size, *shape), dtype=dtype)) for shape in value_shapes]
+        self.last_used = tf.Variable(tf.zeros(size, dtype='int64'))
+        self.clock = tf.Variable(0, dtype='int64')
+        self.hits = tf.Variable(0, dtype='int64')
+        self.misses = tf.Variable(0, dtype='int64')
+
+    def __call__(self, key, compute_fn):
+        '''Returns the values cached for key, calling compute_fn() to fill the cache on a miss'''
+        key_axes = list(range(1, self.keys.shape.rank))
+        matches = tf.reduce_all(tf.equal(self.keys, key[None]), axis=key_axes)
+        self.clock.assign_add(1)
+
+        # The slots are data-dependent, so they are read with gathers and written with
+        # scatters, which (unlike sliced assignment) XLA can compile
+        def hit():
+            slot = tf.argmax(tf.cast(matches, 'int32'))
+            self.hits.assign_add(1)
+            self.last_used.scatter_nd_update([[slot]], [self.clock])
+            return [tf.gather(value, slot) for value in self.values]
+
+        def miss():
+            slot = tf.argmin(self.last_used)
+            values = compute_fn()
+            self.misses.assign_add(1)
+            self.last_used.scatter_nd_update([[slot]], [self.clock])
+            self.keys.scatter_nd_update([[slot]], [key])
+            for cached, value in zip(self.values, values):
+                cached.scatter_nd_update([[slot]], [value])
+            return list(values)
+
+        return tf.cond(tf.reduce_any(matches), hit, miss)
+
 def rotate(matrix, shifts):
     """"requested rotate function - assumes matrix shape is mxn and shifts shape is m"""
 